@@ -0,0 +1,234 @@
+import logging
+import threading
+import time
+
+import settings
+from job_events import publish
+from metrics import record_llm_call
+
+# Agent, LLM and prompt construction for the analyst crew. crewai (and the LLM provider it pulls
+# in) is only imported on first use, so importing this module is cheap; the LLM and prompt
+# templates are built once per process and the analyst Agent once per worker thread, since a
+# crewai Agent keeps per-execution state and is not safe to share between concurrent runs.
+
+# Part of every recommendation cache key; bump when the analyst prompt or optimizer scoring changes
+PROMPT_VERSION = "3"
+
+ANALYST_ROLE = "Fantasy Football Data Analyst Agent"
+ANALYST_GOAL = (
+    "Explain, using the lineup, real world fixture, current league table standings, team and player performance "
+    "data provided to you, why the recommended line up gives the Home team the best chance that gameweek "
+    "to beat the squad of the Away team on most goals scored and fewest goals conceded."
+)
+ANALYST_BACKSTORY = (
+    "You are a fantasy football data analyst who explains lineup recommendations for the home "
+    "team for a given matchweek fixture. The lineup has already been chosen from the squad of "
+    "the home team and the real world Premier League fixtures for that matchweek. "
+    "You will use the current Premier League table and season player performance data "
+    "for each player (and the clubs they play for) to justify each pick."
+)
+
+# Filled per request with prompt_dictionary, matchday, prompt_data and lineup_summary
+ANALYSE_DATA_TEMPLATE = (
+    "Data dictionary: /n{prompt_dictionary} /n"
+    "Home team data for {matchday} ('|' delimited tables with a header row): /n{prompt_data} /n"
+    "Recommended lineup (chosen by the lineup optimizer from expected goals for and against): /n{lineup_summary} /n"
+    "1. Utilise the data dictionary to understand the data definitions and how to effectively use the data in your analysis /n"
+    "2. Use the lineup, real world fixture, league table, player and team attacking and defending stats data provided above. Do not change the recommended lineup /n"
+    "3. The lineup was scored using the rules of the fantasy football game here: /n"
+
+    "On a ‘Match weekend’ your team will have a score calculated as follows: /n"
+
+    "(i) any goals conceded during the relevant weekend by your goalkeeper and /n"
+
+    "defenders will count against you even if you have all 5 players from the /n"
+
+    "same team. For instance – if your goalkeeper and defenders are all Crystal /n"
+
+    "Palace players and they concede 2 goals during their weekend match then /n"
+
+    "all 5 players will count the 2 goals conceded against them hence arriving at /n"
+
+    "a total of 10. /n"
+
+    "(ii) once you have counted up the total number of goals conceded by your /n"
+
+    "goalkeeper and defenders you divide that total by 5 to /n"
+
+    "calculate how many goals your team has conceded. Using the example /n"
+
+    "above your team will have obviously conceded 2 goals. [10 ÷ 5 = 2] /n"
+
+    "(iii) if your defence concedes 11-14 goals in total that will still equate to 2 /n"
+
+    "goals conceded by your team, 15-19 will equate to 3 goals etc. and so on. /n"
+
+    "(iv) your team will then total the number of goals scored by any of your /n"
+
+    "players deemed to have played in your 1st eleven for that /n"
+
+    "weekend/midweek. The organiser will try and verify goal scorers on at /n"
+
+    "least two sites if there are any queries as to who scored. /n"
+
+    "(v) you then subtract the number of goals conceded from the number of goals /n"
+
+    "scored to calculate what your team has scored that weekend. For instance /n"
+
+    "– your defence has conceded 2 goals but 3 of your players have scored. /n"
+
+    "(vi) players do not have to have played a full game to count as having played /n"
+
+    "but any goals conceded during the match will count against defenders /n"
+
+    "even if they only come on for the last minute of the match. /n"
+
+    "(vii) if an own goal is scored by your goalkeeper or defenders there is no /n"
+
+    "added disadvantage to your team. /n"
+
+    "(viii) your team will also concede one extra goal for every position in defence /n"
+
+    "(goalkeeper and 4 defenders) that you fail to field. /n"
+
+    "(ix) On a 'match weekend' your team will have a score by the API calculated as follows. /n"
+    "The organiser will use the details issued or standing on the morning after a set of matches have been played /n"
+    "and this will stand even if any other official 'dubious goals' committee credit someone else as scoring that goal at /n"
+    "a later date. Due to the way the fantasy football league is run there will be no facility to change goal scorers and any /n"
+    "subsequent match scores due to this process. /n"
+
+    "4. Explain each player in the recommended lineup individually taking into consideration thier individual and club attacking and defending stats, the real world fixture and league table. /n"
+)
+ANALYSE_DATA_EXPECTED_OUTPUT = "The recommended home team lineup exactly as given, with a short and concise summary on one line per player of why they were picked, always highlighting along the way the stats used."
+
+_llm = None
+_llm_lock = threading.Lock()
+_thread_state = threading.local()
+# First-seen start or end event of each in-flight LLM call, by call_id, with when it was seen. A call
+# whose other event never arrives is dropped after LLM_CALL_EVENT_TTL seconds.
+_llm_call_events = {}
+LLM_CALL_EVENT_TTL = 600
+_llm_call_lock = threading.Lock()
+
+
+def register_llm_listeners():
+    # crewai reports every LLM call on its event bus. Handlers run on its thread pool in a copy of
+    # the calling thread's context, so timings and token usage land on the job that made the call,
+    # but the start and end handlers can run in either order: whichever comes second records it.
+    from crewai.events import crewai_event_bus, LLMCallStartedEvent, LLMCallCompletedEvent, LLMCallFailedEvent, LLMStreamChunkEvent
+
+    def pair(source, event):
+        with _llm_call_lock:
+            other = _llm_call_events.pop(event.call_id, (None, None))[1]
+            if other is None:
+                now = time.monotonic()
+                # Insertion order is arrival order, so stale entries are at the front
+                while _llm_call_events and now - next(iter(_llm_call_events.values()))[0] > LLM_CALL_EVENT_TTL:
+                    del _llm_call_events[next(iter(_llm_call_events))]
+                _llm_call_events[event.call_id] = (now, event)
+                return
+        started, finished = sorted((other, event), key=lambda e: isinstance(e, LLMCallStartedEvent), reverse=True)
+        failed = isinstance(finished, LLMCallFailedEvent)
+        seconds = (finished.timestamp - started.timestamp).total_seconds()
+        record_llm_call(finished.model, seconds, None if failed else finished.usage, failed=failed)
+
+    for event_type in (LLMCallStartedEvent, LLMCallCompletedEvent, LLMCallFailedEvent):
+        crewai_event_bus.on(event_type)(pair)
+
+    # Stream chunks are handled synchronously on the calling thread, in order, and forwarded to
+    # the job's SSE subscribers
+    @crewai_event_bus.on(LLMStreamChunkEvent)
+    def on_stream_chunk(source, event):
+        if event.chunk and event.tool_call is None:
+            publish("token", {"text": event.chunk})
+
+
+def get_llm():
+    global _llm
+    with _llm_lock:
+        if _llm is None:
+            from crewai import LLM
+            register_llm_listeners()
+            _llm = LLM(
+                model=settings.LLM_MODEL,
+                api_key=settings.GEMINI_API_KEY,
+                base_url="https://generativelanguage.googleapis.com",
+                temperature=0.7,
+                stream=settings.LLM_STREAM
+            )
+        return _llm
+
+
+def use_llm(llm):
+    # Replace the shared LLM, e.g. with a stub for offline benchmarks. Agents already built by a
+    # worker thread keep the previous LLM, so call this before the first request.
+    global _llm
+    with _llm_lock:
+        if _llm is None:
+            register_llm_listeners()
+        _llm = llm
+
+
+def limit_llm_calls(acquire):
+    # Runs acquire() before every LLM call made in this process, e.g. to wait on a rate limit
+    # shared by several worker processes (see main.py)
+    from crewai.hooks import register_before_llm_call_hook
+
+    def wait_for_slot(context):
+        acquire()
+        return None
+
+    register_before_llm_call_hook(wait_for_slot)
+
+
+def get_analyst_agent():
+    agent = getattr(_thread_state, "analyst_agent", None)
+    if agent is None:
+        from crewai import Agent
+        agent = Agent(
+            role=ANALYST_ROLE,
+            goal=ANALYST_GOAL,
+            backstory=ANALYST_BACKSTORY,
+            allow_delegation=False,
+            llm=get_llm(),
+            verbose=settings.CREW_VERBOSE
+        )
+        _thread_state.analyst_agent = agent
+    return agent
+
+
+def build_analysis_crew(prompt_dictionary: str, matchday: str, prompt_data: str, lineup_summary: str):
+    from crewai import Crew, Task
+
+    agent = get_analyst_agent()
+    # Task context is built from the prefetched query results for this user
+    analyse_data = Task(
+        description=ANALYSE_DATA_TEMPLATE.format(
+            prompt_dictionary=prompt_dictionary,
+            matchday=matchday,
+            prompt_data=prompt_data,
+            lineup_summary=lineup_summary
+        ),
+        expected_output=ANALYSE_DATA_EXPECTED_OUTPUT,
+        agent=agent,
+    )
+    return Crew(
+        agents=[agent],
+        tasks=[analyse_data],
+        verbose=settings.CREW_VERBOSE
+    )
+
+
+def warm_up() -> dict:
+    # Pay the crewai import and LLM client construction cost before the first request needs it.
+    # Agents are kept per worker thread (see get_analyst_agent), so none is built here: one built on
+    # the warm-up thread would never be used.
+    timings = {}
+    started = time.perf_counter()
+    import crewai  # noqa: F401
+    timings["crewai_import_seconds"] = round(time.perf_counter() - started, 3)
+    started = time.perf_counter()
+    get_llm()
+    timings["llm_client_seconds"] = round(time.perf_counter() - started, 3)
+    logging.info(f"Agents warmed up: {timings}")
+    return timings
@@ -0,0 +1,455 @@
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Offline end-to-end benchmark for the lineup service. It seeds a SQLite (or any SQLAlchemy URL)
+# stand-in for Cloud SQL with a synthetic league using the schema implied by the data dictionary,
+# swaps Gemini for a deterministic stub LLM with a fixed latency, then drives N requests (C at a
+# time) either through the FastAPI app over HTTP or straight into execute_crew_workflow, with
+# callbacks posted to a local sink. Reports latency percentiles, throughput, peak memory and SQL
+# statement counts.
+#
+#   python benchmark.py --users 200 --requests 500 --concurrency 50 --llm-latency 0.5
+#   python benchmark.py --target workflow --requests 100 --json-output bench.json
+
+MATCHDAY_PREFIX = "Regular Season - "
+SEASON = "25-26"
+ACCOUNT_ID = 1
+# Squad shape per user and the number of players each club contributes to the league pool
+SQUAD_POSITIONS = {"Goalkeeper": 2, "Defender": 6, "Midfielder": 6, "Attacker": 4}
+CLUB_POSITIONS = {"Goalkeeper": 3, "Defender": 8, "Midfielder": 8, "Attacker": 6}
+
+# Keys and filter columns the prefetch queries rely on that the data dictionary does not describe
+EXTRA_COLUMNS = {
+    "users": [("id", "String"), ("account_id", "Integer")],
+    "teams": [("id", "Integer"), ("name", "String")],
+    "players": [("api_player_id", "String/Int"), ("name", "String"), ("teams_id", "String/Int"), ("account_id", "Integer")],
+    "teamsheets": [("user_id", "String"), ("position", "String"), ("season", "String"), ("account_id", "Integer")],
+    "player_statistics": [("updated_at", "Datetime")],
+}
+
+
+# 1. Schema and synthetic league
+def schema_from_dictionary(path: str) -> dict[str, dict[str, str]]:
+    # table -> {column: inferred type}, in dictionary order, plus the extra key columns
+    tables = {}
+    with open(path, encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            tables.setdefault(row["Source Database Table"], {}).setdefault(row["Column Name"], row["Inferred Type"])
+    for table, columns in EXTRA_COLUMNS.items():
+        for column, kind in columns:
+            tables.setdefault(table, {}).setdefault(column, kind)
+    return tables
+
+
+def _column_type(kind: str):
+    from sqlalchemy import DateTime, Float, Integer, String
+    if kind in ("Integer", "String/Int"):
+        return Integer
+    if kind.startswith("Float"):
+        return Float
+    if kind == "Datetime":
+        return DateTime
+    return String
+
+
+def _random_value(kind: str, rng: random.Random):
+    # Filler for dictionary columns the generator has no specific rule for
+    if kind in ("Integer", "String/Int"):
+        return rng.randint(0, 50)
+    if kind.startswith("Float"):
+        return round(rng.uniform(0, 10), 2)
+    if kind == "Datetime":
+        return datetime(2026, 1, 1) + timedelta(minutes=rng.randint(0, 525600))
+    return f"value {rng.randint(0, 999)}"
+
+
+def _round_robin(team_ids: list[int]) -> list[list[tuple[int, int]]]:
+    # Circle method: every club plays every other club once per half-season, home and away swapped in the second half
+    teams = list(team_ids) + ([None] if len(team_ids) % 2 else [])
+    rounds = []
+    for _ in range(len(teams) - 1):
+        pairs = [(teams[i], teams[-1 - i]) for i in range(len(teams) // 2)]
+        rounds.append([(home, away) for home, away in pairs if home is not None and away is not None])
+        teams = [teams[0], teams[-1]] + teams[1:-1]
+    return rounds + [[(away, home) for home, away in pairs] for pairs in rounds]
+
+
+def generate_league(teams: int, users: int, seed: int) -> dict[str, list[dict]]:
+    rng = random.Random(seed)
+    rows = {table: [] for table in ("users", "teams", "players", "teamsheets", "prem_fixtures", "player_statistics", "team_statistics", "standings")}
+    team_names = {team_id: f"Club {team_id}" for team_id in range(1, teams + 1)}
+    played = 2 * (teams - 1)
+
+    for team_id, name in team_names.items():
+        rows["teams"].append({"id": team_id, "name": name, "team": name})
+        home_for, away_for = rng.uniform(0.8, 2.4), rng.uniform(0.6, 2.0)
+        home_against, away_against = rng.uniform(0.6, 1.8), rng.uniform(0.8, 2.2)
+        half = played // 2
+        rows["team_statistics"].append({
+            "team_id": team_id, "name": name, "played_home": half, "played_away": half, "played_total": played,
+            "goals_against_home": round(home_against * half), "goals_against_away": round(away_against * half),
+            "avg_goals_against_home": round(home_against, 2), "avg_goals_against_away": round(away_against, 2),
+            "avg_goals_against_total": round((home_against + away_against) / 2, 2),
+            "clean_sheets_home": rng.randint(0, half // 2), "clean_sheets_away": rng.randint(0, half // 3),
+            "wins_home": rng.randint(0, half // 2), "wins_away": rng.randint(0, half // 2),
+            "draws_home": rng.randint(0, half // 4), "draws_away": rng.randint(0, half // 4),
+            "losses_home": rng.randint(0, half // 3), "losses_away": rng.randint(0, half // 2),
+            "goals_for_home": round(home_for * half), "goals_for_away": round(away_for * half),
+            "avg_goals_for_home": round(home_for, 2), "avg_goals_for_away": round(away_for, 2),
+            "avg_goals_for_total": round((home_for + away_for) / 2, 2),
+            "failed_to_score_home": rng.randint(0, half // 3), "failed_to_score_away": rng.randint(0, half // 2),
+        })
+
+    points = {team_id: rng.randint(10, 90) for team_id in team_names}
+    for rank, team_id in enumerate(sorted(points, key=points.get, reverse=True), start=1):
+        wins, draws = points[team_id] // 3, points[team_id] % 3
+        rows["standings"].append({
+            "id": rank, "rank": rank, "team_id": team_id, "team_name": team_names[team_id], "points": points[team_id],
+            "goals_diff": rng.randint(-30, 40), "form": "".join(rng.choice("WDL") for _ in range(5)), "played": played,
+            "wins": wins, "draws": draws, "losses": max(0, played - wins - draws),
+        })
+
+    for number, pairs in enumerate(_round_robin(list(team_names)), start=1):
+        for home, away in pairs:
+            rows["prem_fixtures"].append({
+                "round": f"{MATCHDAY_PREFIX}{number}", "hteamid": home, "hteamname": team_names[home],
+                "ateamid": away, "ateamname": team_names[away],
+            })
+
+    pool = {position: [] for position in CLUB_POSITIONS}
+    api_player_id = 0
+    for team_id, team_name in team_names.items():
+        for position, count in CLUB_POSITIONS.items():
+            for _ in range(count):
+                api_player_id += 1
+                pool[position].append(api_player_id)
+                name = f"Player {api_player_id}"
+                appearances = rng.randint(0, played)
+                rows["players"].append({"api_player_id": api_player_id, "name": name, "position": position, "teams_id": team_id, "account_id": ACCOUNT_ID})
+                scorer = {"Goalkeeper": 0.0, "Defender": 0.05, "Midfielder": 0.15, "Attacker": 0.4}[position]
+                rows["player_statistics"].append({
+                    "api_player_id": api_player_id, "name": name, "injured": "true" if rng.random() < 0.08 else "false",
+                    "team_id": team_id, "team_name": team_name, "appearances": appearances, "lineups": rng.randint(0, appearances),
+                    "position": position, "rating": round(rng.uniform(6.0, 8.0), 2),
+                    "goals_total": sum(rng.random() < scorer for _ in range(appearances)),
+                    "goals_conceded": rng.randint(0, appearances * 2), "goals_saves": rng.randint(0, appearances * 3) if position == "Goalkeeper" else None,
+                })
+
+    for user_id in range(1, users + 1):
+        rows["users"].append({"id": str(user_id), "formation": rng.choice(["4-4-2", "4-3-3"]), "account_id": ACCOUNT_ID})
+        for position, count in SQUAD_POSITIONS.items():
+            for picked in rng.sample(pool[position], count):
+                rows["teamsheets"].append({
+                    "user_id": str(user_id), "api_player_id": picked, "name": f"Player {picked}",
+                    "position": position, "season": SEASON, "account_id": ACCOUNT_ID,
+                })
+    return rows
+
+
+def seed_database(url: str, dictionary_path: str, teams: int, users: int, seed: int) -> dict[str, int]:
+    from sqlalchemy import Column, MetaData, Table, create_engine
+
+    league = generate_league(teams, users, seed)
+    # Only database tables; the dictionary also documents derived ones such as player_features
+    schema = {name: columns for name, columns in schema_from_dictionary(dictionary_path).items() if name in league}
+    metadata = MetaData()
+    tables = {
+        name: Table(name, metadata, *(Column(column, _column_type(kind)) for column, kind in columns.items()))
+        for name, columns in schema.items()
+    }
+    rng = random.Random(seed + 1)
+    engine = create_engine(url)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    counts = {}
+    with engine.begin() as conn:
+        for name, table_rows in league.items():
+            columns = schema[name]
+            filled = [{column: row[column] if column in row else _random_value(kind, rng) for column, kind in columns.items()} for row in table_rows]
+            for start in range(0, len(filled), 5000):
+                conn.execute(tables[name].insert(), filled[start:start + 5000])
+            counts[name] = len(filled)
+    engine.dispose()
+    return counts
+
+
+# 2. Stub LLM
+def make_stub_llm(latency: float):
+    from crewai.events.types.llm_events import LLMCallType
+    from crewai.llms.base_llm import BaseLLM, llm_call_context
+    from serialization import estimate_tokens
+
+    class StubLLM(BaseLLM):
+        # Deterministic stand-in for Gemini: sleeps for a fixed latency and answers in the ReAct
+        # format crewai expects, with token usage estimated from the prompt
+        latency: float = 0.0
+
+        def call(self, messages, tools=None, callbacks=None, available_functions=None, from_task=None, from_agent=None, response_model=None):
+            with llm_call_context():
+                self._emit_call_started_event(messages=messages, from_task=from_task, from_agent=from_agent)
+                prompt = messages if isinstance(messages, str) else "\n".join(str(m.get("content", "")) for m in messages)
+                time.sleep(self.latency)
+                digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+                answer = f"Thought: I now know the final answer\nFinal Answer: Stub explanation {digest} for the recommended lineup."
+                # Mirror a streaming provider so the SSE endpoint sees analyst tokens
+                for word in answer.split(" "):
+                    self._emit_stream_chunk_event(chunk=f"{word} ", from_task=from_task, from_agent=from_agent, call_type=LLMCallType.LLM_CALL)
+                usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(answer)}
+                self._emit_call_completed_event(
+                    response=answer, call_type=LLMCallType.LLM_CALL, from_task=from_task, from_agent=from_agent,
+                    messages=messages, usage=usage,
+                )
+                return answer
+
+    return StubLLM(model="stub", latency=latency)
+
+
+# 3. Callback sink
+class CallbackSink:
+    def __init__(self):
+        self.received = {}
+        self.listeners = {}
+        self._lock = threading.Lock()
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(200)
+                self.end_headers()
+                sink.record(self.path.rsplit("/", 1)[-1], json.loads(body or b"{}"))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/callbacks"
+        threading.Thread(target=self.server.serve_forever, name="callback-sink", daemon=True).start()
+
+    def record(self, request_id: str, payload: dict):
+        with self._lock:
+            self.received[request_id] = (time.perf_counter(), payload)
+            listener = self.listeners.pop(request_id, None)
+        if listener:
+            listener()
+
+    def on_callback(self, request_id: str, listener):
+        with self._lock:
+            if request_id not in self.received:
+                self.listeners[request_id] = listener
+                return
+        listener()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+# 4. Load drivers
+def _request_plan(requests: int, users: int, seed: int) -> list[tuple[str, str]]:
+    rng = random.Random(seed + 2)
+    return [(f"r{i}", str(rng.randint(1, users))) for i in range(requests)]
+
+
+async def drive_api(app, plan, matchday: str, concurrency: int, sink: CallbackSink, timeout: float) -> tuple[list[dict], float]:
+    import httpx
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, name="uvicorn", daemon=True)
+    thread.start()
+    while not server.started:
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(client, request_id, user_id):
+        async with semaphore:
+            done = asyncio.Event()
+            sink.on_callback(request_id, lambda: loop.call_soon_threadsafe(done.set))
+            started = time.perf_counter()
+            response = await client.post(f"http://127.0.0.1:{port}/api/v1/lineup-analysis", json={
+                "user_id": user_id, "callback_url": f"{sink.url}/{request_id}", "matchday": matchday, "team_name": f"User {user_id}",
+            })
+            if response.status_code != 202:
+                return {"request_id": request_id, "outcome": f"http_{response.status_code}"}
+            try:
+                await asyncio.wait_for(done.wait(), timeout)
+            except asyncio.TimeoutError:
+                return {"request_id": request_id, "outcome": "timeout"}
+            received, payload = sink.received[request_id]
+            return {"request_id": request_id, "outcome": payload.get("status"), "latency": received - started, "timings": payload.get("timings")}
+
+    try:
+        async with httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=concurrency)) as client:
+            started = time.perf_counter()
+            results = await asyncio.gather(*(one(client, request_id, user_id) for request_id, user_id in plan))
+            return results, time.perf_counter() - started
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+
+
+def drive_workflow(plan, matchday: str, concurrency: int, sink: CallbackSink) -> tuple[list[dict], float]:
+    import fast_api
+    from database import dispose_engine, init_engine
+    from webhooks import callback_dispatcher
+
+    init_engine()
+    callback_dispatcher.start()
+
+    def one(request_id, user_id):
+        started = time.perf_counter()
+        payload = fast_api.execute_crew_workflow(user_id, f"{sink.url}/{request_id}", matchday, f"User {user_id}")
+        return {"request_id": request_id, "outcome": payload.get("status"), "latency": time.perf_counter() - started, "timings": payload.get("timings")}
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as executor:
+            results = list(executor.map(lambda item: one(*item), plan))
+        return results, time.perf_counter() - started
+    finally:
+        callback_dispatcher.stop()
+        dispose_engine()
+
+
+# 5. Report
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 4), "p95": round(float(p95), 4), "p99": round(float(p99), 4), "max": round(max(values), 4)}
+
+
+def build_report(results: list[dict], wall_seconds: float, args) -> dict:
+    from metrics import SQL_QUERY_SECONDS
+
+    outcomes = {}
+    for result in results:
+        outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+    completed = [result for result in results if result["outcome"] == "completed"]
+    stages = {}
+    tokens = {"llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    for result in completed:
+        timings = result.get("timings") or {}
+        for stage, seconds in timings.get("stages", {}).items():
+            stages.setdefault(stage, []).append(seconds)
+        tokens["llm_calls"] += len(timings.get("llm_calls", []))
+        tokens["prompt_tokens"] += timings.get("prompt_tokens", 0)
+        tokens["completion_tokens"] += timings.get("completion_tokens", 0)
+
+    # Every statement goes through queries.execute, which counts it per label. SQLAlchemy cursor
+    # events would miss the statements prepared and run directly on pg8000.
+    queries = {}
+    for metric in SQL_QUERY_SECONDS.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_count"):
+                queries[sample.labels["query"]] = int(sample.value)
+    sql_statements = sum(queries.values())
+    # ru_maxrss is KiB on Linux (bytes on macOS)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        "config": {
+            "target": args.target, "requests": args.requests, "concurrency": args.concurrency, "users": args.users,
+            "teams": args.teams, "llm_latency": args.llm_latency, "recommendation_cache": args.recommendation_cache, "dedupe": args.dedupe,
+        },
+        "outcomes": outcomes,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_per_second": round(len(completed) / wall_seconds, 2) if wall_seconds else None,
+        "latency_seconds": _percentiles([result["latency"] for result in completed]),
+        "stage_seconds": {stage: _percentiles(values) for stage, values in stages.items()},
+        "sql_statements": sql_statements,
+        "sql_statements_per_request": round(sql_statements / len(results), 2) if results else None,
+        "sql_queries_by_label": queries,
+        "llm": tokens,
+        "peak_rss_mb": round(peak_rss, 1),
+    }
+
+
+def print_report(report: dict):
+    print(f"\nBenchmark: {report['config']}")
+    print(f"Outcomes: {report['outcomes']} in {report['wall_seconds']}s ({report['throughput_per_second']} completed/s)")
+    print(f"Latency (s): {report['latency_seconds']}")
+    for stage, values in report["stage_seconds"].items():
+        print(f"  {stage}: {values}")
+    print(f"SQL statements: {report['sql_statements']} ({report['sql_statements_per_request']} per request)")
+    print(f"SQL queries by label: {report['sql_queries_by_label']}")
+    print(f"LLM: {report['llm']}")
+    print(f"Peak RSS: {report['peak_rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark with a synthetic league and a stub LLM")
+    parser.add_argument("--target", choices=["api", "workflow"], default="api", help="HTTP endpoint via uvicorn, or execute_crew_workflow directly")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--teams", type=int, default=20)
+    parser.add_argument("--matchday", type=int, default=1, help="Round number to analyse")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds the stub LLM sleeps per call")
+    parser.add_argument("--database-url", help="Seed and use this database instead of a temporary SQLite file")
+    parser.add_argument("--recommendation-cache", action="store_true", help="Keep the recommendation cache on (repeat users become cache hits)")
+    parser.add_argument("--dedupe", action="store_true", help="Keep duplicate-request coalescing on (concurrent requests for one user share a job)")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json-output", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="farpost-bench-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    # Settings are read at import time, so configure the service before importing it
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("CREW_VERBOSE", "false")
+    os.environ.setdefault("WARMUP_ON_STARTUP", "false")
+    os.environ.setdefault("PROMPT_SIZE_LOGGING", "false")
+    os.environ.setdefault("JOB_MAX_QUEUE_DEPTH", str(max(args.requests, 100)))
+    if not args.recommendation_cache:
+        os.environ["RECOMMENDATION_CACHE_MAX_ENTRIES"] = "0"
+        os.environ.pop("RECOMMENDATION_CACHE_DIR", None)
+    if not args.dedupe:
+        os.environ["DEDUPE_REQUESTS"] = "false"
+
+    import logging
+    import settings
+
+    started = time.perf_counter()
+    counts = seed_database(database_url, settings.DATA_DICTIONARY_PATH, args.teams, args.users, args.seed)
+    print(f"Seeded {database_url} in {time.perf_counter() - started:.1f}s: {counts}")
+
+    import agents
+    import fast_api
+    logging.getLogger().setLevel(logging.WARNING)
+    agents.use_llm(make_stub_llm(args.llm_latency))
+
+    sink = CallbackSink()
+    plan = _request_plan(args.requests, args.users, args.seed)
+    matchday = f"{MATCHDAY_PREFIX}{args.matchday}"
+    if args.target == "api":
+        results, wall_seconds = asyncio.run(drive_api(fast_api.app, plan, matchday, args.concurrency, sink, args.timeout))
+    else:
+        results, wall_seconds = drive_workflow(plan, matchday, args.concurrency, sink)
+    sink.stop()
+
+    report = build_report(results, wall_seconds, args)
+    print_report(report)
+    if args.json_output:
+        with open(args.json_output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
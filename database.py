@@ -0,0 +1,76 @@
+import logging
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+import settings
+
+# One engine (and connection pool) per process. Created at FastAPI startup via init_engine(),
+# or lazily on first use by scripts that never call it explicitly.
+_engine = None
+_connector = None
+_lock = threading.Lock()
+
+
+def _pool_kwargs(url: str) -> dict:
+    kwargs = {"pool_recycle": settings.DB_POOL_RECYCLE, "pool_pre_ping": True}
+    if not url.startswith("sqlite"):
+        kwargs.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+        )
+    return kwargs
+
+
+def _create_cloud_sql_engine() -> Engine:
+    # Imported here so local DATABASE_URL runs and cold starts don't pay for the connector
+    from google.cloud.sql.connector import Connector, IPTypes
+
+    global _connector
+    _connector = Connector()
+
+    def getconn():
+        return _connector.connect(
+            settings.INSTANCE_CONNECTION_NAME,
+            "pg8000",
+            user=settings.DB_USER,
+            password=settings.DB_PASS,
+            db=settings.DB_NAME,
+            ip_type=IPTypes.PUBLIC
+        )
+
+    url = "postgresql+pg8000://"
+    return create_engine(url, creator=getconn, **_pool_kwargs(url))
+
+
+def init_engine() -> Engine:
+    global _engine
+    with _lock:
+        if _engine is None:
+            if settings.DATABASE_URL:
+                _engine = create_engine(settings.DATABASE_URL, **_pool_kwargs(settings.DATABASE_URL))
+                logging.info(f"Database engine created for {_engine.url.render_as_string(hide_password=True)}")
+            else:
+                _engine = _create_cloud_sql_engine()
+                logging.info(f"Cloud SQL engine created for {settings.INSTANCE_CONNECTION_NAME}")
+        return _engine
+
+
+def get_engine() -> Engine:
+    if _engine is None:
+        return init_engine()
+    return _engine
+
+
+def dispose_engine():
+    global _engine, _connector
+    with _lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+        if _connector is not None:
+            _connector.close()
+            _connector = None
+    logging.info("Database engine disposed")
@@ -1,233 +1,412 @@
-import os
+import time
+_import_started = time.perf_counter()
+
+import asyncio
+import contextvars
+import hmac
 import warnings
 import logging
-import httpx
-from fastapi import FastAPI, BackgroundTasks, HTTPException
-from pydantic import BaseModel, HttpUrl
-from sqlalchemy import create_engine, text
-from google.cloud.sql.connector import Connector, IPTypes
-
-# CrewAI imports
-from crewai import Agent, Task, Crew, Process, LLM
-from crewai.tools import BaseTool
-from crewai_tools import FileReadTool
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, HttpUrl
+
+# crewai and the Cloud SQL connector are imported lazily on first use (see agents.py, database.py)
+import settings
+from agents import warm_up
+from database import init_engine, dispose_engine
+from feature_store import feature_store
+from league_cache import league_cache
+from queries import execute
+from prefetch import PrefetchedData, prefetch_user_data, prefetch_batch_data
+from pipeline import analyse_user
+from simulation import simulate_matchweek
+from job_queue import Job, JobQueue, JobCancelled, QueueFull, QUEUED, COMPLETED, FAILED, CANCELLED, FINISHED_STATUSES
+from webhooks import callback_dispatcher
+from metrics import JOB_QUEUE_DEPTH, render_latest, span, track_job
+from job_events import TERMINAL_EVENTS, job_events, publish, scope
+from singleflight import SingleFlight, RECENT
 
 warnings.filterwarnings('ignore')
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI(title="Fantasy Football CrewAI Service")
-
-# 1. Initialization Config
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-my_llm = LLM(
-    model='gemini/gemini-2.5-flash',
-    api_key=GEMINI_API_KEY,
-    base_url="https://generativelanguage.googleapis.com",
-    temperature=0.7
-)
-
-data_dictionary_file_read_tool = FileReadTool(file_path='farpost_data_dictionary.csv')
-
-# 2. Database Tool
-class CloudSQLQueryTool(BaseTool):
-    name: str = "Cloud SQL Query Tool"
-    description: str = "Use this tool to query the Google Cloud SQL database. Input should be a raw SQL query."
-
-    def _run(self, query: str) -> str:
-        connector = Connector()
-        def getconn():
-            return connector.connect(
-                os.environ.get("INSTANCE_CONNECTION_NAME"),
-                "pg8000",
-                user=os.environ.get("DB_USER"),
-                password=os.environ.get("DB_PASS"),
-                db=os.environ.get("DB_NAME"),
-                ip_type=IPTypes.PUBLIC
-            )
-        engine = create_engine("postgresql+pg8000://", creator=getconn)
-        with engine.connect() as conn:
-            result = conn.execute(text(query))
-            rows = result.fetchall()
-            return str(rows)
-
-cloud_sql_tool = CloudSQLQueryTool()
+# Startup timings, logged once the app is ready and exposed on /api/v1/health
+startup_report = {"module_import_seconds": round(time.perf_counter() - _import_started, 3)}
 
-# 3. Pydantic Schema for incoming Rails requests
+def run_warm_up():
+    try:
+        started = time.perf_counter()
+        startup_report.update(warm_up())
+        # Open one pooled connection so the first request skips the TLS/IAM handshake
+        execute("warm_up")
+        startup_report["warm_up_seconds"] = round(time.perf_counter() - started, 3)
+    except Exception as e:
+        logging.error(f"Warm-up failed: {str(e)}")
+    logging.info(f"Startup report: {startup_report}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    # Open the shared Cloud SQL connection pool once for the whole service
+    init_engine()
+    callback_dispatcher.start()
+    job_queue.start()
+    startup_report["lifespan_startup_seconds"] = round(time.perf_counter() - started, 3)
+    # Warm up in the background so the port binds immediately; jobs that arrive first simply
+    # wait on the same imports
+    if settings.WARMUP_ON_STARTUP:
+        threading.Thread(target=run_warm_up, name="warm-up", daemon=True).start()
+    else:
+        logging.info(f"Startup report: {startup_report}")
+    yield
+    job_queue.stop()
+    callback_dispatcher.stop()
+    dispose_engine()
+
+app = FastAPI(title="Fantasy Football CrewAI Service", lifespan=lifespan)
+
+# 1. Initialization Config (LLM and agents are built on first use in agents.py; the per-user analysis is in pipeline.py)
+
+# 2. Pydantic Schema for incoming Rails requests
 class CrewRequest(BaseModel):
     user_id: str
-    callback_url: str
+    callback_url: HttpUrl
     matchday: str
     team_name: str
+    # Higher priority jobs are taken from the queue first
+    priority: int = Field(0, ge=-10, le=10)
 
-# 4. Asynchronous Background Worker
-def execute_crew_workflow(user_id: str, callback_url: str, matchday: str, team_name: str):
-    logging.info(f"Starting CrewAI execution for user_id: {user_id}")
-    try:
-        # Define Agents
-        ff_data_collection_agent = Agent(
-            role="Fantasy Football Data Collection Agent",
-            goal="Retrieve Fantasy Football data from relevant data sources which will inform the fantasy football data analyst agent",
-            backstory=(
-                "Your job is to retrieve a set of pre-defined fantasy football related data. "
-                "These data sets include home team squad data for the current matchweek, "
-                "the real world fixtures for the current matchweek in the Premier League, "
-                "the current Premier League table standings, "
-                "the attacking and defending performance data for the current season of each player and club they play for found in the line ups, "
-                "the current injuries data for players in the Premier League. "
-    
-            ),
-            allow_delegation=False,
-            llm=my_llm,
-            tools=[cloud_sql_tool, data_dictionary_file_read_tool],
-            verbose=True
-        )
-
-        ff_data_analyst_agent = Agent(
-            role="Fantasy Football Data Analyst Agent",
-            goal="Analyse the lineup, real world fixture, current league table standings, team and player performance "
-            "data provided by the fantasy football data collection agent in order to recommend the best "
-            "line up for the Home team for that gameweek in order to beat the squad of the Away team on most goals scored and fewest goals conceded.",
-            backstory=(
-                "You are a fantasy football data analyst who aims to recommend the best lineup for the home "
-                "team for a given matchweek fixture. You will base your recommendation off of the squad of "
-                "the home team and the real world Premier League fixtures for that matchweek. "
-                "In addition to these data sets, you will also utilise the current Premier League table and "
-                "season player performance data for each player (and the clubs they play for) in the lineups to make the recommendation."
-            ),
-            allow_delegation=False,
-            llm=my_llm,
-            verbose=True
-        )
-
-        # Tasks dynamically modifying user_id based on the Rails request payload
-        extract_data = Task(
-            description=(
-                f"1. Extract the home team formation using the cloud_sql_tool via this SQL Query 'select formation from users where id = '{user_id}';'\n"
-                f"2. Extract home team squad data using the cloud_sql_tool via this SQL Query 'select t.api_player_id, t.name, p.position, te.name as team from teamsheets t left join players p on t.api_player_id = p.api_player_id left join teams te on p.teams_id = te.id where user_id = '{user_id}' and p.account_id = t.account_id ORDER BY position;'\n"
-                f"3. Extract the current matchweeks fixture data using the cloud_sql_tool via this SQL Query 'select round, hteamid, hteamname, ateamid, ateamname from prem_fixtures where round = '{matchday}';'\n"
-                f"4. Extract the player attacking stats data for each home team player using the cloud_sql_tool via this SQL Query 'SELECT api_player_id, name, injured, team_id, team_name, appearances, lineups, position, rating, shots_total, shots_on, goals_total, goals_assists, passes_key, passes_accuracy, dribbles_attempts, dribbles_success, fouls_drawn FROM player_statistics WHERE api_player_id IN (SELECT api_player_id FROM teamsheets WHERE user_id = '{user_id}' and season = '25-26');'\n"
-                f"5. Extract the team defensive stats data for each home team players club using the cloud_sql_tool via this SQL Query 'select team_id, name, played_home, played_away, played_total, goals_against_home, goals_against_away, avg_goals_against_home, avg_goals_against_away, avg_goals_against_total, clean_sheets_home, clean_sheets_away from team_statistics WHERE team_id IN (SELECT id FROM teams where id IN (SELECT p.teams_id FROM teamsheets t LEFT JOIN players p ON t.api_player_id = p.api_player_id WHERE t.user_id = '{user_id}' and season = '25-26'));'\n"
-                f"6. Extract the team attacking stats data for each home team players club using the cloud_sql_tool via this SQL Query 'select team_id, name, played_home, played_away, played_total, wins_home, wins_away, draws_home, draws_away, losses_home, losses_away goals_for_home, goals_for_away, avg_goals_for_home, avg_goals_for_away, avg_goals_for_total, failed_to_score_home, failed_to_score_away from team_statistics WHERE team_id IN (SELECT id FROM teams where id IN (SELECT p.teams_id FROM teamsheets t LEFT JOIN players p ON t.api_player_id = p.api_player_id WHERE t.user_id = '{user_id}' and season = '25-26'));'\n"
-                f"7. Extract the player defensive stats data for each home team player via the api_player_id from the home team player using the cloud_sql_tool via this SQL Query 'select api_player_id, name, injured, team_id, team_name, appearances, lineups, position, rating, goals_conceded, tackles_total, tackles_blocks, tackles_interceptions, duels_total, duels_won, fouls_committed from player_statistics WHERE api_player_id IN (SELECT api_player_id FROM teamsheets WHERE user_id = '{user_id}' and position = 'Defender' and season = '25-26');'\n"
-                f"8. Extract the goalkeeper stats data for each home team player using the cloud_sql_tool via this SQL Query 'select api_player_id, name, team_id, team_name, appearances, lineups, position, rating, goals_conceded, goals_saves, duels_total, duels_won FROM player_statistics WHERE api_player_id IN (SELECT api_player_id FROM teamsheets WHERE user_id = '{user_id}' and season = '25-26' and position = 'Goalkeeper');'\n"
-                f"9. Extract the current injured players data for the Premier League from the home team lineup data using the cloud_sql_tool via this SQL Query 'select api_player_id, name, injured, team_id, team_name, position from player_statistics WHERE api_player_id IN (SELECT api_player_id FROM teamsheets WHERE user_id = '{user_id}' and season = '26-27');'. If a player is injured remove the player from the recommendation\n"
-                f"10. Extract the current Premier League table using the cloud_sql_tool via this SQL Query 'select * from standings;'"
-                f"11. Extract the data dictionary definitions of all data extracted via SQL using the data_dictionary_file_read_tool."
-
-            ),
-            expected_output="A comprehensive set of data you can provide to the Fantasy Football Data Analyst Agent",
-            agent=ff_data_collection_agent,
-        )
-
-        analyse_data = Task(
-            description=(
-                "1. Utilise the data dictionary to understand the data definitions and how to effectively use the data in your analysis /n"
-                "2. Analyse the lineup, real world fixture, league table, player and team attacking and defending stats data provided by the data collection agent /n"
-                "3. Use the rules of the fantasy football game here: /n"
-
-        "On a ‘Match weekend’ your team will have a score calculated as follows: /n"
-
-        "(i) any goals conceded during the relevant weekend by your goalkeeper and /n"
-
-        "defenders will count against you even if you have all 5 players from the /n"
-
-        "same team. For instance – if your goalkeeper and defenders are all Crystal /n"
-
-        "Palace players and they concede 2 goals during their weekend match then /n"
-
-        "all 5 players will count the 2 goals conceded against them hence arriving at /n"
-
-        "a total of 10. /n"
-
-        "(ii) once you have counted up the total number of goals conceded by your /n"
-
-        "goalkeeper and defenders you divide that total by 5 to /n"
-
-        "calculate how many goals your team has conceded. Using the example /n"
-
-        "above your team will have obviously conceded 2 goals. [10 ÷ 5 = 2] /n"
-
-        "(iii) if your defence concedes 11-14 goals in total that will still equate to 2 /n"
-
-        "goals conceded by your team, 15-19 will equate to 3 goals etc. and so on. /n"
-
-        "(iv) your team will then total the number of goals scored by any of your /n"
-
-        "players deemed to have played in your 1st eleven for that /n"
-
-        "weekend/midweek. The organiser will try and verify goal scorers on at /n"
-
-        "least two sites if there are any queries as to who scored. /n"
-
-        "(v) you then subtract the number of goals conceded from the number of goals /n"
-
-        "scored to calculate what your team has scored that weekend. For instance /n"
-
-        "– your defence has conceded 2 goals but 3 of your players have scored. /n"
-
-        "(vi) players do not have to have played a full game to count as having played /n"
-
-        "but any goals conceded during the match will count against defenders /n"
-
-        "even if they only come on for the last minute of the match. /n"
-
-        "(vii) if an own goal is scored by your goalkeeper or defenders there is no /n"
-
-        "added disadvantage to your team. /n"
+class BatchUser(BaseModel):
+    user_id: str
+    team_name: str | None = None
+    # Per-user callback; omit to only receive the aggregated callback
+    callback_url: HttpUrl | None = None
 
-        "(viii) your team will also concede one extra goal for every position in defence /n"
+class BatchCrewRequest(BaseModel):
+    matchday: str
+    users: list[BatchUser] = []
+    # Alternatively run every user with a squad in this account
+    account_id: str | None = None
+    # Aggregated callback with every user's result once the whole batch has finished
+    callback_url: HttpUrl | None = None
+    priority: int = Field(0, ge=-10, le=10)
+
+class SimulationRequest(BaseModel):
+    user_id: str
+    # The user whose squad the home user faces this matchday
+    away_user_id: str
+    matchday: str
+    # Home lineups to compare, each a list of api_player_ids; defaults to the optimizer's top picks
+    lineups: list[list[int | str]] = []
+    # Defaults to the away user's optimizer pick
+    away_lineup: list[int | str] | None = None
+    simulations: int = settings.SIMULATION_COUNT
+    # Fix the random draws to reproduce a result; the seed used is always returned
+    seed: int | None = None
+
+# 3. Asynchronous Background Worker
+# Simulations are CPU and memory heavy, so only SIMULATION_WORKERS run at once; others queue here
+simulation_executor = ThreadPoolExecutor(max_workers=settings.SIMULATION_WORKERS, thread_name_prefix="simulation")
+
+# Users of every batch job are analysed here, so concurrent batches share BATCH_WORKERS threads between them
+batch_executor = ThreadPoolExecutor(max_workers=settings.BATCH_WORKERS, thread_name_prefix="batch")
+
+def run_lineup_simulation(request: SimulationRequest) -> dict:
+    # Monte Carlo scoring of lineups against the away squad; no LLM involved
+    with track_job() as timings:
+        with span("prefetch"):
+            prefetched = prefetch_batch_data([request.user_id, request.away_user_id], request.matchday)
+        with span("simulation"):
+            result = simulate_matchweek(
+                prefetched[request.user_id], prefetched[request.away_user_id],
+                lineups=request.lineups, away_lineup=request.away_lineup,
+                simulations=request.simulations, seed=request.seed, top_k=settings.OPTIMIZER_TOP_K,
+            )
+    result["timings"] = timings.as_dict()
+    return result
 
-        "(goalkeeper and 4 defenders) that you fail to field. /n"
+def send_callback(callback_url: str, payload: dict, user_id: str):
+    # Post back to Rails Webhook Controller; delivery and retries happen off the worker thread
+    callback_dispatcher.dispatch(callback_url, payload, label=f"user_id: {user_id}")
 
-        "(ix) On a 'match weekend' your team will have a score by the API calculated as follows. /n"
-        "The organiser will use the details issued or standing on the morning after a set of matches have been played /n"
-        "and this will stand even if any other official 'dubious goals' committee credit someone else as scoring that goal at /n"
-        "a later date. Due to the way the fantasy football league is run there will be no facility to change goal scorers and any /n"
-        "subsequent match scores due to this process. /n"
+def execute_crew_workflow(user_id: str, callback_url: str | None, matchday: str, team_name: str, job: Job | None = None) -> dict:
+    logging.info(f"Starting CrewAI execution for user_id: {user_id}")
 
-        "to recommend the best lineup. /n"
-        "4. Analyse each player in the Home team lineup individually taking into consideration thier individual and club attacking and defending stats, the real world fixture, league table and injury data. /n"
-            ),
-            expected_output="Recommendation of the home team lineup (if the team formation is 4-4-2 then 1 Goalkeeper, 4 Defenders, 4 Midfielders, 2 Strikers or if the formation is 4-3-3 1 Goalkeeper, 4 Defenders, 3 Midfielders, 3 Strikers) the fantasy football player should select for the gameweek in order to beat the away team squad based on all data available, game rules and ensuring the player is not injured and makes a high number of appearances for his team. Ensure the players picked are only players from the home team lineup data even if there are no stats available attacking and defending wise for an individual player. Provide a short and concise summary on one line per player of the logic used always highlighting along the way the stats used.",
-            agent=ff_data_analyst_agent,
-        )
+    def load() -> PrefetchedData:
+        # Run the fixed set of SQL queries for this user and matchday in parallel
+        prefetched = prefetch_user_data(user_id, matchday)
+        if job:
+            job.check_cancelled()
+        return prefetched
+
+    payload = analyse_user(user_id, team_name, load)
+    if callback_url:
+        send_callback(callback_url, payload, user_id)
+    return payload
+
+def execute_batch_workflow(matchday: str, users: list[BatchUser], callback_url: str | None, account_id: str | None = None, job: Job | None = None) -> dict:
+    prefetched, prefetch_error = {}, None
+    # Batch-level timings; each user's payload carries its own breakdown from analyse_user
+    with track_job() as timings:
+        try:
+            with span("batch_prefetch"):
+                if account_id:
+                    known = {user.user_id for user in users}
+                    account_users = execute("account_users", {"account_id": account_id, "season": settings.SEASON})
+                    users = users + [BatchUser(user_id=str(row[0])) for row in account_users.rows if str(row[0]) not in known]
+                logging.info(f"Starting batch CrewAI execution for {len(users)} users on {matchday}")
+                # One set-based query per table for every squad, plus the shared league-wide tables
+                prefetched = prefetch_batch_data([user.user_id for user in users], matchday)
+        except Exception as e:
+            prefetch_error = e
+    if job:
+        job.check_cancelled()
+
+    def analyse(user: BatchUser) -> dict:
+        def load() -> PrefetchedData:
+            if prefetch_error:
+                raise prefetch_error
+            if job:
+                job.check_cancelled()
+            return prefetched[user.user_id]
+
+        payload = analyse_user(user.user_id, user.team_name, load)
+        publish("user_completed", {"user_id": user.user_id, "status": payload["status"]})
+        if user.callback_url:
+            send_callback(user.callback_url, payload, user.user_id)
+        return payload
+
+    # A fresh copy of the context per user keeps progress events tagged with this job
+    futures = [batch_executor.submit(contextvars.copy_context().run, analyse, user) for user in users]
+    results = [future.result() for future in futures]
+
+    # Completed only if every user completed, failed if none did (e.g. the prefetch failed)
+    failed = sum(result["status"] != "completed" for result in results)
+    status = "completed" if not failed else "failed" if failed == len(results) else "partial"
+    payload = {
+        "status": status,
+        "matchday": matchday,
+        "results": results,
+        "timings": timings.as_dict()
+    }
+    if status == "failed":
+        payload["error"] = str(prefetch_error) if prefetch_error else "Every user in the batch failed"
+    if callback_url:
+        callback_dispatcher.dispatch(callback_url, payload, label=f"batch of {len(users)} users")
+    return payload
+
+def flight_key(user_id: str, matchday: str, team_name: str) -> tuple:
+    return (user_id, matchday, team_name)
+
+def run_single_job(job: Job) -> dict:
+    params = dict(job.params)
+    # Jobs persisted before request coalescing carry a single callback_url
+    callback_urls = params.pop("callback_urls", None) or [params.pop("callback_url")]
+    payload = None
+    try:
+        payload = execute_crew_workflow(callback_url=None, job=job, **params)
+    except JobCancelled:
+        payload = cancelled_payload(job)
+        raise
+    finally:
+        # After landing no more duplicates attach, so callback_urls is final
+        lineup_flights.land(flight_key(params["user_id"], params["matchday"], params["team_name"]), job, payload)
+        # One execution, one callback per distinct URL that asked for it (a failed job has no payload to send)
+        if payload is not None:
+            for callback_url in callback_urls:
+                send_callback(callback_url, payload, params["user_id"])
+    return payload
+
+def cancelled_payload(job: Job) -> dict:
+    return {
+        "status": "cancelled",
+        "user_id": job.params["user_id"],
+        "job_id": job.job_id
+    }
+
+def run_workflow(job: Job) -> dict:
+    if job.kind == "batch":
+        params = dict(job.params)
+        users = [BatchUser(**user) for user in params.pop("users")]
+        return execute_batch_workflow(users=users, job=job, **params)
+    return run_single_job(job)
+
+def run_job(job: Job) -> dict:
+    # Progress events published anywhere in the workflow go to this job's SSE subscribers
+    with scope(job_id=job.job_id):
+        publish("started")
+        try:
+            payload = run_workflow(job)
+        except JobCancelled:
+            publish("cancelled")
+            raise
+        except Exception as e:
+            publish("failed", {"error": str(e)})
+            raise
+        publish("failed" if payload.get("status") == "failed" else "result", payload)
+        return payload
+
+# Bounded worker pool that runs the crew workflows; see job_queue.py
+job_queue = JobQueue(
+    handler=run_job,
+    workers=settings.JOB_WORKERS,
+    max_depth=settings.JOB_MAX_QUEUE_DEPTH,
+    store_path=settings.JOB_STORE_PATH,
+    retention=settings.JOB_RETENTION
+)
+JOB_QUEUE_DEPTH.set_function(job_queue.depth)
 
-        crew = Crew(
-            agents=[ff_data_collection_agent, ff_data_analyst_agent],
-            tasks=[extract_data, analyse_data],
-            verbose=True
-        )
+# Duplicate single-user requests share one job (see singleflight.py); attached callback URLs are persisted with the job
+lineup_flights = SingleFlight(freshness=settings.DEDUPE_FRESHNESS_SECONDS, on_attach=job_queue.persist)
 
-        # Kickoff orchestration
-        result = crew.kickoff()
-        
-        # Outbound Payload back to Ruby on Rails
-        payload = {
-            "status": "completed",
-            "user_id": user_id,
-            "matchday": matchday,
-            "team_name": team_name,
-            "result": str(result.raw)
-        }
-    except Exception as e:
-        logging.error(f"Crew failed for user {user_id}: {str(e)}")
-        payload = {
-            "status": "failed",
-            "user_id": user_id,
-            "error": str(e)
-        }
-
-    # Post back to Rails Webhook Controller
+def enqueue_job(kind: str, params: dict, priority: int) -> Job:
+    try:
+        job = job_queue.submit(kind, params, priority=priority)
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(settings.JOB_RETRY_AFTER)})
+    job_events.publish(job.job_id, "queued", {"queue_depth": job_queue.depth()})
+    return job
+
+# 4. FastAPI HTTP Entry Endpoint
+@app.post("/api/v1/lineup-analysis", status_code=202)
+async def start_analysis(request: CrewRequest):
+    # Enqueue the job instantly and respond with 202 (or 429 when the queue is saturated)
+    def start(callback_urls: list[str]) -> Job:
+        return enqueue_job("single", {
+            "user_id": request.user_id,
+            "callback_urls": callback_urls,
+            "matchday": request.matchday,
+            "team_name": request.team_name
+        }, request.priority)
+
+    callback_url = str(request.callback_url)
+    if not settings.DEDUPE_REQUESTS:
+        job = start([callback_url])
+        return {"status": "processing", "job_id": job.job_id, "message": "CrewAI agents are running asynchronously. A webhook will follow."}
+
+    # A duplicate of a queued or running request attaches to that job; one that just completed gets its result
+    job, outcome, payload = lineup_flights.join(flight_key(request.user_id, request.matchday, request.team_name), callback_url, start)
+    if outcome == RECENT:
+        send_callback(callback_url, payload, request.user_id)
+        return {"status": "completed", "job_id": job.job_id, "coalesced": outcome, "message": "A matching analysis has just completed. Its result has been sent to the webhook."}
+    return {"status": "processing", "job_id": job.job_id, "coalesced": outcome, "message": "CrewAI agents are running asynchronously. A webhook will follow."}
+
+@app.post("/api/v1/lineup-analysis/batch", status_code=202)
+async def start_batch_analysis(request: BatchCrewRequest):
+    if not request.users and not request.account_id:
+        raise HTTPException(status_code=400, detail="Provide users or an account_id")
+    # Users resolved from an account have no per-user callback, so the aggregated one is required
+    if not request.callback_url and (request.account_id or any(not user.callback_url for user in request.users)):
+        raise HTTPException(status_code=400, detail="Every user needs a callback_url unless an aggregated callback_url is given")
+
+    job = enqueue_job("batch", {
+        "matchday": request.matchday,
+        # Stored as JSON with the job, so URLs are kept as strings
+        "users": [user.model_dump(mode="json") for user in request.users],
+        "callback_url": str(request.callback_url) if request.callback_url else None,
+        "account_id": request.account_id
+    }, request.priority)
+    return {"status": "processing", "job_id": job.job_id, "message": "CrewAI agents are running asynchronously. Webhooks will follow."}
+
+@app.post("/api/v1/lineup-simulation")
+async def simulate_lineups(request: SimulationRequest):
+    # Answered directly rather than through the job queue: a simulation takes well under a second
+    if not 1 <= request.simulations <= settings.SIMULATION_MAX:
+        raise HTTPException(status_code=400, detail=f"simulations must be between 1 and {settings.SIMULATION_MAX}")
     try:
-        with httpx.Client() as client:
-            client.post(callback_url, json=payload, timeout=30.0)
-        logging.info(f"Callback successfully sent to Rails for user_id: {user_id}")
-    except Exception as callback_err:
-        logging.error(f"Failed to transmit callback to Rails: {str(callback_err)}")
-
-# 5. FastAPI HTTP Entry Endpoint
-@app.post("/api/v1/lineup-analysis")
-async def start_analysis(request: CrewRequest, background_tasks: BackgroundTasks):
-    # Enqueue execution thread instantly and respond with 202
-    background_tasks.add_task(execute_crew_workflow, request.user_id, str(request.callback_url), request.matchday, request.team_name)
-    return {"status": "processing", "message": "CrewAI agents are running asynchronously. A webhook will follow."}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(simulation_executor, contextvars.copy_context().run, run_lineup_simulation, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/v1/lineup-analysis/{job_id}")
+async def get_analysis(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.as_dict()
+
+@app.delete("/api/v1/lineup-analysis/{job_id}")
+async def cancel_analysis(job_id: str):
+    queued = getattr(job_queue.get(job_id), "status", None) == QUEUED
+    job = job_queue.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if queued and job.status == CANCELLED:
+        # A queued job never runs, so close its stream and tell its callbacks here; a running one does both when it stops
+        job_events.publish(job_id, "cancelled", {})
+        if job.kind == "single":
+            params = job.params
+            lineup_flights.land(flight_key(params["user_id"], params["matchday"], params["team_name"]), job, None)
+            for callback_url in params.get("callback_urls") or [params["callback_url"]]:
+                send_callback(callback_url, cancelled_payload(job), params["user_id"])
+    return job.as_dict()
+
+# Terminal stream event for a job that finished before anyone subscribed (or before a restart)
+FINAL_EVENTS = {COMPLETED: "result", FAILED: "failed", CANCELLED: "cancelled"}
+
+@app.get("/api/v1/lineup-analysis/{job_id}/stream")
+async def stream_analysis(job_id: str, last_event_id: str | None = Header(default=None)):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status in FINISHED_STATUSES:
+        # No-op when the job's own terminal event is still in the history
+        job_events.publish(job_id, FINAL_EVENTS[job.status], job.result or {"error": job.error})
+    # Event ids are sequence numbers; anything else replays the whole history rather than failing the reconnect
+    after = int(last_event_id) if last_event_id and last_event_id.strip().isdigit() else 0
+    subscriber, backlog, finished = job_events.subscribe(job_id, after)
+
+    async def events():
+        try:
+            for job_event in backlog:
+                yield job_event.encode()
+            if finished:
+                return
+            while not (subscriber.lagged and subscriber.queue.empty()):
+                try:
+                    job_event = await asyncio.wait_for(subscriber.queue.get(), settings.STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield job_event.encode()
+                if job_event.event in TERMINAL_EVENTS:
+                    return
+        finally:
+            job_events.unsubscribe(job_id, subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Prometheus scrape endpoint: stage, SQL, LLM and callback latency histograms plus token and job counters
+@app.get("/metrics")
+async def metrics():
+    body, content_type = render_latest()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/api/v1/health")
+async def health():
+    return {"status": "ok", "queue_depth": job_queue.depth(), "startup": startup_report}
+
+# 5. Admin endpoints
+def check_admin_key(x_admin_key: str | None):
+    # Admin endpoints are disabled unless ADMIN_API_KEY is set
+    if not settings.ADMIN_API_KEY:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest((x_admin_key or "").encode("utf-8"), settings.ADMIN_API_KEY.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Invalid admin key")
+
+# Drop cached league-wide tables (e.g. after fixtures or standings are updated)
+@app.delete("/api/v1/admin/league-cache")
+async def invalidate_league_cache(matchday: str | None = None, season: str | None = None, x_admin_key: str | None = Header(default=None)):
+    check_admin_key(x_admin_key)
+    removed = league_cache.invalidate(matchday=matchday, season=season)
+    # Player feature tables are refreshed incrementally on next use rather than dropped
+    stale = feature_store.invalidate(matchday=matchday, season=season)
+    return {"status": "invalidated", "entries": removed, "player_feature_tables": stale}
+
+@app.get("/api/v1/admin/callbacks/dead-letters")
+async def list_dead_letters(x_admin_key: str | None = Header(default=None)):
+    check_admin_key(x_admin_key)
+    return {"dead_letters": list(callback_dispatcher.dead_letters)}
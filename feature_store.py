@@ -0,0 +1,309 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from urllib.parse import quote
+
+import numpy as np
+
+import settings
+
+# Per-matchday feature table for every Premier League player. Each player's season stats
+# (player_statistics) are joined in memory to their club's and this round's opponent's team
+# statistics from the cached league tables, and held as NumPy columns sorted by api_player_id with
+# derived rates (goals per appearance, start rate, play probability, fixture goals for/against,
+# expected goals) computed vectorised. The first load reads every player; later refreshes read only
+# rows whose updated_at is at or after the newest one already seen, merge them in, and recompute
+# features only for players whose inputs (stats, injury status, club or fixture data) changed.
+# Invalidating a table (the admin cache endpoint) makes its next refresh a full reload, which also
+# drops deleted players. Per-user requests look their squad up by api_player_id with a binary
+# search. With FEATURE_STORE_DIR set, each table is also written as one .npy file per column and
+# opened memory-mapped, so several worker processes share the same pages.
+
+# Columns joined from the club's and the opponent's team_statistics rows
+TEAM_COLUMNS = ["played_total", "avg_goals_for_home", "avg_goals_for_away", "avg_goals_for_total", "avg_goals_against_home", "avg_goals_against_away"]
+OPPONENT_COLUMNS = ["avg_goals_for_home", "avg_goals_for_away", "avg_goals_against_home", "avg_goals_against_away"]
+# Features computed from the raw columns, in the order they are sent to the analyst
+DERIVED_COLUMNS = [
+    "play_probability", "start_rate", "goals_per_appearance", "opponent_goals_conceded",
+    "fixture_goals_for", "fixture_goals_against", "expected_goals",
+]
+STRING_COLUMNS = {"name", "injured", "team_name", "position", "venue", "opponent"}
+# For players whose club has no games recorded, and for squad players with no player_statistics row
+DEFAULT_PLAY_PROBABILITY = 0.5
+
+
+def _row_hashes(raw: dict[str, np.ndarray]) -> np.ndarray:
+    # Hash of each player's inputs after conversion to columns, so a row rebuilt from a previous
+    # table hashes the same as the row read again from the database. Stable across processes
+    # (unlike hash()), so persisted tables can be diffed after a restart.
+    columns = list(raw.values())
+    return np.array([
+        int.from_bytes(hashlib.blake2b(repr(tuple(column[i].item() for column in columns)).encode("utf-8"), digest_size=8).digest(), "little")
+        for i in range(len(raw["api_player_id"]))
+    ], dtype=np.uint64)
+
+
+def fixture_lookup(fixtures) -> dict:
+    # str(team_id) -> (opponent team_id, opponent name, venue) from the round's fixtures. A club with
+    # two fixtures in the round keeps the one listed first after sorting, whatever order the rows came in.
+    lookup = {}
+    for fixture in sorted(fixtures.as_dicts(), key=lambda row: (str(row["hteamid"]), str(row["ateamid"]))):
+        lookup.setdefault(str(fixture["hteamid"]), (fixture["ateamid"], fixture["ateamname"], "home"))
+        lookup.setdefault(str(fixture["ateamid"]), (fixture["hteamid"], fixture["hteamname"], "away"))
+    return lookup
+
+
+def join_league(player_columns: list[str], players: list[tuple], league: dict) -> tuple[list[str], list[tuple]]:
+    # Adds the club's team statistics, this round's venue and opponent, and the opponent's team
+    # statistics to each player row; league holds the round's "fixtures" and "team_statistics" tables
+    team_statistics = {str(row["team_id"]): row for row in league["team_statistics"].as_dicts()}
+    fixtures = fixture_lookup(league["fixtures"])
+    team_index = player_columns.index("team_id")
+    rows = []
+    for player in players:
+        team = team_statistics.get(str(player[team_index]), {})
+        opponent_id, opponent_name, venue = fixtures.get(str(player[team_index]), (None, None, None))
+        opponent = team_statistics.get(str(opponent_id), {})
+        rows.append(
+            tuple(player) + tuple(team.get(column) for column in TEAM_COLUMNS) + (venue, opponent_name)
+            + tuple(opponent.get(column) for column in OPPONENT_COLUMNS)
+        )
+    columns = player_columns + TEAM_COLUMNS + ["venue", "opponent"] + [f"opponent_{column}" for column in OPPONENT_COLUMNS]
+    return columns, rows
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray, default: float = 0.0) -> np.ndarray:
+    out = np.full(numerator.shape, default, dtype=np.float64)
+    np.divide(numerator, denominator, out=out, where=(denominator > 0) & ~np.isnan(denominator))
+    return np.nan_to_num(out, nan=default)
+
+
+def _venue_pick(venue: np.ndarray, home: np.ndarray, away: np.ndarray) -> np.ndarray:
+    return np.where(venue == "home", home, np.where(venue == "away", away, np.nan))
+
+
+def fixture_rates(team_for, team_against, opponent_for, opponent_against):
+    # Expected goals for and against a club in a fixture: its own venue average blended with what
+    # the opponent typically concedes/scores at the opposite venue. Works on arrays or plain numbers.
+    return (team_for + opponent_against) / 2, (team_against + opponent_for) / 2
+
+
+def compute_features(raw: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    # The only place player rates are computed: the optimizer and the simulation read these columns
+    venue = raw["venue"]
+    value = {name: np.nan_to_num(column) for name, column in raw.items() if column.dtype.kind == "f"}
+    team_for = _venue_pick(venue, value["avg_goals_for_home"], value["avg_goals_for_away"])
+    team_against = _venue_pick(venue, value["avg_goals_against_home"], value["avg_goals_against_away"])
+    # The opponent plays at the other venue
+    opponent_against = _venue_pick(venue, value["opponent_avg_goals_against_away"], value["opponent_avg_goals_against_home"])
+    opponent_for = _venue_pick(venue, value["opponent_avg_goals_for_away"], value["opponent_avg_goals_for_home"])
+    fixture_goals_for, fixture_goals_against = fixture_rates(team_for, team_against, opponent_for, opponent_against)
+
+    play_probability = np.minimum(1.0, _ratio(value["appearances"], value["played_total"], DEFAULT_PLAY_PROBABILITY))
+    goals_per_appearance = _ratio(value["goals_total"], value["appearances"])
+    fixture_multiplier = _ratio(np.nan_to_num(fixture_goals_for), value["avg_goals_for_total"], 1.0)
+    fixture_multiplier = np.where(value["avg_goals_for_total"] > 0, fixture_multiplier, 1.0)
+    return {
+        "play_probability": play_probability,
+        "start_rate": _ratio(value["lineups"], value["appearances"]),
+        "goals_per_appearance": goals_per_appearance,
+        "opponent_goals_conceded": opponent_against,
+        "fixture_goals_for": fixture_goals_for,
+        "fixture_goals_against": fixture_goals_against,
+        # Players whose club has no fixture this round cannot score
+        "expected_goals": np.where(np.isnan(fixture_goals_for), 0.0, play_probability * goals_per_appearance * fixture_multiplier),
+    }
+
+
+def _columnize(columns: list[str], rows: list[tuple]) -> dict[str, np.ndarray]:
+    arrays = {}
+    for i, column in enumerate(columns):
+        values = [row[i] for row in rows]
+        if column == "api_player_id":
+            arrays[column] = np.array(values, dtype=np.int64)
+        elif column in STRING_COLUMNS:
+            arrays[column] = np.array(["" if value is None else str(value) for value in values], dtype=str)
+        else:
+            arrays[column] = np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+    return arrays
+
+
+def _python(value):
+    # NumPy scalars back to plain values for prompts and JSON; missing numbers back to None
+    value = value.item()
+    if isinstance(value, float):
+        if np.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    return None if value == "" else value
+
+
+class MatchdayFeatures:
+    def __init__(self, matchday: str, columns: dict[str, np.ndarray], built_at: float,
+                 player_columns: list[str] | None = None, updated_through=None):
+        self.matchday = matchday
+        self.columns = columns
+        self.built_at = built_at
+        self.ids = columns["api_player_id"]
+        # The player_statistics columns the table was built from, and the newest updated_at among
+        # them; both are None for a table loaded from disk, whose next refresh is then a full reload
+        self.player_columns = player_columns
+        self.updated_through = updated_through
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def locate(self, api_player_ids) -> tuple[np.ndarray, np.ndarray]:
+        # Row index for each id, and whether it was found
+        keys = np.asarray(api_player_ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, keys)
+        clipped = np.minimum(positions, max(len(self.ids) - 1, 0))
+        found = (positions < len(self.ids)) & (self.ids[clipped] == keys) if len(self.ids) else np.zeros(len(keys), dtype=bool)
+        return clipped, found
+
+    def row(self, index: int, columns: list[str]) -> tuple:
+        return tuple(_python(self.columns[column][index]) for column in columns)
+
+    def player_rows(self) -> dict[int, tuple]:
+        return {int(api_player_id): self.row(index, self.player_columns) for index, api_player_id in enumerate(self.ids)}
+
+
+class FeatureStore:
+    def __init__(self, ttl: int = 300, store_dir: str | None = None, incremental: bool = True):
+        self.ttl = ttl
+        self.store_dir = store_dir
+        self.incremental = incremental
+        self._tables = {}
+        self._stale = set()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key: tuple) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, season: str, matchday: str, loader, league: dict) -> MatchdayFeatures:
+        # loader(since) returns player_statistics rows (a QueryResult with an updated_at column):
+        # every row when since is None, otherwise those updated at or after since. league holds the
+        # round's "fixtures" and "team_statistics" tables.
+        key = (season, matchday)
+        features = self._tables.get(key)
+        if features is not None and key not in self._stale and time.time() - features.built_at < self.ttl:
+            return features
+        # One refresh per key at a time; concurrent requests wait for it rather than re-running the query
+        with self._key_lock(key):
+            features = self._tables.get(key)
+            if features is None:
+                features = self._load(key)
+            if features is None or key in self._stale or time.time() - features.built_at >= self.ttl:
+                features = self._refresh(matchday, features, loader, league, full=key in self._stale)
+                self._save(key, features)
+                self._stale.discard(key)
+            self._tables[key] = features
+            return features
+
+    def invalidate(self, matchday: str | None = None, season: str | None = None) -> int:
+        # Marks tables for a full reload on next use; the old table is kept so only changed players are recomputed
+        with self._lock:
+            keys = [key for key in self._tables if (season is None or key[0] == season) and (matchday is None or key[1] == matchday)]
+            self._stale.update(keys)
+        return len(keys)
+
+    def _read_players(self, previous: MatchdayFeatures | None, loader, full: bool) -> tuple[list[str], dict[int, tuple], object]:
+        # Player rows by api_player_id, and the newest updated_at among them
+        incremental = self.incremental and not full and previous is not None and previous.player_columns is not None and previous.updated_through is not None
+        result = loader(previous.updated_through if incremental else None)
+        updated_index = result.columns.index("updated_at")
+        id_index = result.columns.index("api_player_id")
+        player_columns = [column for column in result.columns if column != "updated_at"]
+        players = previous.player_rows() if incremental else {}
+        updated_through = previous.updated_through if incremental else None
+        seen = set()
+        for row in result.rows:
+            api_player_id = int(row[id_index])
+            # Rows are ordered so a player's preferred row comes first; later duplicates are ignored
+            if api_player_id in seen:
+                continue
+            seen.add(api_player_id)
+            players[api_player_id] = tuple(value for i, value in enumerate(row) if i != updated_index)
+            if row[updated_index] is not None and (updated_through is None or row[updated_index] > updated_through):
+                updated_through = row[updated_index]
+        if len(seen) < len(result.rows):
+            logging.warning(f"player_statistics has {len(result.rows) - len(seen)} duplicate player rows; kept the one with most appearances")
+        return player_columns, players, updated_through
+
+    def _refresh(self, matchday: str, previous: MatchdayFeatures | None, loader, league: dict, full: bool = False) -> MatchdayFeatures:
+        started = time.perf_counter()
+        player_columns, players, updated_through = self._read_players(previous, loader, full)
+        columns, rows = join_league(player_columns, [players[api_player_id] for api_player_id in sorted(players)], league)
+        raw = _columnize(columns, rows)
+        hashes = _row_hashes(raw)
+
+        unchanged = np.zeros(len(rows), dtype=bool)
+        if previous is not None and len(previous):
+            positions, found = previous.locate(raw["api_player_id"])
+            unchanged = found & (previous.columns["input_hash"][positions] == hashes)
+        changed = np.flatnonzero(~unchanged)
+
+        derived = {column: np.empty(len(rows), dtype=np.float64) for column in DERIVED_COLUMNS}
+        if unchanged.any():
+            kept = positions[unchanged]
+            for column in DERIVED_COLUMNS:
+                derived[column][unchanged] = previous.columns[column][kept]
+        if changed.size:
+            computed = compute_features({column: values[changed] for column, values in raw.items()})
+            for column in DERIVED_COLUMNS:
+                derived[column][changed] = computed[column]
+
+        logging.info(
+            f"Player features for {matchday}: recomputed {changed.size} of {len(rows)} players "
+            f"in {time.perf_counter() - started:.3f}s"
+        )
+        return MatchdayFeatures(
+            matchday, {**raw, **derived, "input_hash": hashes}, built_at=time.time(),
+            player_columns=player_columns, updated_through=updated_through,
+        )
+
+    def _path(self, key: tuple) -> str:
+        season, matchday = key
+        return os.path.join(self.store_dir, quote(season, safe=""), quote(matchday, safe=""))
+
+    def _save(self, key: tuple, features: MatchdayFeatures):
+        if not self.store_dir:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(tmp_path, exist_ok=True)
+            for column, values in features.columns.items():
+                np.save(os.path.join(tmp_path, f"{column}.npy"), values)
+            # Swap the whole directory so readers never see a mix of old and new columns
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Failed to persist player features for {key}: {str(e)}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _load(self, key: tuple) -> MatchdayFeatures | None:
+        if not self.store_dir or not os.path.isdir(self._path(key)):
+            return None
+        path = self._path(key)
+        try:
+            columns = {
+                name[:-4]: np.load(os.path.join(path, name), mmap_mode="r")
+                for name in os.listdir(path) if name.endswith(".npy")
+            }
+            built_at = os.path.getmtime(os.path.join(path, "api_player_id.npy"))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable player features for {key}: {str(e)}")
+            return None
+        if not {"api_player_id", "input_hash", *DERIVED_COLUMNS} <= columns.keys():
+            return None
+        return MatchdayFeatures(key[1], columns, built_at=built_at)
+
+
+feature_store = FeatureStore(ttl=settings.FEATURE_STORE_TTL, store_dir=settings.FEATURE_STORE_DIR, incremental=settings.FEATURE_STORE_INCREMENTAL)
@@ -0,0 +1,140 @@
+import asyncio
+import contextvars
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import settings
+
+# In-process pub/sub for job progress, feeding the SSE stream endpoint. Workflows publish stage
+# events (and analyst tokens) from worker threads; each SSE client subscribes with an asyncio queue
+# on the server's event loop and events are handed over with call_soon_threadsafe, so a publish is
+# one dict append plus one loop callback per subscriber. Every job keeps a short history so late
+# subscribers (or reconnects with Last-Event-ID) replay what they missed, and a closed job's topic is
+# dropped after a retention period.
+
+# Events after which no more are published for a job
+TERMINAL_EVENTS = {"result", "failed", "cancelled"}
+
+_scope = contextvars.ContextVar("job_event_scope", default=None)
+
+
+@dataclass
+class JobEvent:
+    id: int
+    event: str
+    data: dict
+
+    def encode(self) -> str:
+        return f"id: {self.id}\nevent: {self.event}\ndata: {json.dumps(self.data, default=str)}\n\n"
+
+
+@dataclass(eq=False)
+class Subscriber:
+    loop: asyncio.AbstractEventLoop
+    queue: asyncio.Queue
+    # Set when the client fell too far behind; the stream ends and the client can reconnect
+    lagged: bool = False
+
+
+@dataclass
+class Topic:
+    history: deque
+    sequence: int = 0
+    subscribers: set = field(default_factory=set)
+    closed_at: float | None = None
+
+
+class JobEventBroker:
+    def __init__(self, history: int = 1000, retention: int = 300, subscriber_queue_size: int = 1000):
+        self.history = history
+        self.retention = retention
+        self.subscriber_queue_size = subscriber_queue_size
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def _topic(self, job_id: str) -> Topic:
+        topic = self._topics.get(job_id)
+        if topic is None:
+            topic = self._topics[job_id] = Topic(history=deque(maxlen=self.history))
+        return topic
+
+    def publish(self, job_id: str, event: str, data: dict):
+        with self._lock:
+            topic = self._topic(job_id)
+            if topic.closed_at is not None:
+                return
+            topic.sequence += 1
+            job_event = JobEvent(id=topic.sequence, event=event, data=data)
+            topic.history.append(job_event)
+            if event in TERMINAL_EVENTS:
+                topic.closed_at = time.time()
+            subscribers = list(topic.subscribers)
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(self._deliver, topic, subscriber, job_event)
+        if event in TERMINAL_EVENTS:
+            self._prune()
+
+    def _deliver(self, topic: Topic, subscriber: Subscriber, job_event: JobEvent):
+        # Runs on the subscriber's event loop
+        try:
+            subscriber.queue.put_nowait(job_event)
+        except asyncio.QueueFull:
+            subscriber.lagged = True
+            with self._lock:
+                topic.subscribers.discard(subscriber)
+
+    def subscribe(self, job_id: str, last_event_id: int = 0) -> tuple[Subscriber, list[JobEvent], bool]:
+        # Must be called on the event loop that will read the queue. Returns the subscriber, the
+        # history after last_event_id and whether the job has already finished.
+        self._prune()
+        subscriber = Subscriber(loop=asyncio.get_running_loop(), queue=asyncio.Queue(maxsize=self.subscriber_queue_size))
+        with self._lock:
+            topic = self._topic(job_id)
+            backlog = [job_event for job_event in topic.history if job_event.id > last_event_id]
+            finished = topic.closed_at is not None
+            if not finished:
+                topic.subscribers.add(subscriber)
+        return subscriber, backlog, finished
+
+    def unsubscribe(self, job_id: str, subscriber: Subscriber):
+        with self._lock:
+            topic = self._topics.get(job_id)
+            if topic is not None:
+                topic.subscribers.discard(subscriber)
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        with self._lock:
+            expired = [job_id for job_id, topic in self._topics.items() if topic.closed_at is not None and topic.closed_at < cutoff]
+            for job_id in expired:
+                del self._topics[job_id]
+
+
+@contextmanager
+def scope(**fields):
+    # Tag events published in this context (and copies of it) with job_id, user_id, ...
+    token = _scope.set({**(_scope.get() or {}), **fields})
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def publish(event: str, data: dict | None = None):
+    # Publishes to the job bound by scope(); a no-op outside a job (e.g. the CLI runner)
+    fields = _scope.get()
+    if not fields or "job_id" not in fields:
+        return
+    tags = {key: value for key, value in fields.items() if key != "job_id"}
+    job_events.publish(fields["job_id"], event, {**tags, **(data or {})})
+
+
+job_events = JobEventBroker(
+    history=settings.STREAM_HISTORY_EVENTS,
+    retention=settings.STREAM_RETENTION,
+    subscriber_queue_size=settings.STREAM_SUBSCRIBER_QUEUE_SIZE,
+)
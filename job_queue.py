@@ -0,0 +1,245 @@
+import itertools
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from metrics import JOBS, STAGE_SECONDS
+
+# Bounded worker pool for lineup jobs. Requests are queued (highest priority first) up to a
+# maximum depth and run by a fixed number of worker threads; when the queue is full submit()
+# raises QueueFull so the API can answer 429 instead of piling more blocking crew runs onto the
+# server's threadpool. Jobs can optionally be persisted to a local SQLite file so queued work
+# survives a restart.
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (COMPLETED, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    kind: str
+    params: dict
+    priority: int = 0
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    error: str | None = None
+    result: dict | None = None
+    cancel_requested: bool = False
+
+    def check_cancelled(self):
+        # Called by workflows between stages; a running crew cannot be interrupted mid-call
+        if self.cancel_requested:
+            raise JobCancelled(f"Job {self.job_id} was cancelled")
+
+    def timings(self) -> dict:
+        now = time.time()
+        return {
+            "queued_seconds": round((self.started_at or self.finished_at or now) - self.created_at, 3),
+            "run_seconds": round((self.finished_at or now) - self.started_at, 3) if self.started_at else None,
+        }
+
+    def as_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "priority": self.priority,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "timings": self.timings(),
+            "error": self.error,
+            "result": self.result,
+        }
+
+
+class JobStore:
+    # SQLite persistence for jobs; one connection per call keeps it safe across worker threads
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "create table if not exists jobs (job_id text primary key, kind text, params text, priority integer, "
+                "status text, created_at real, started_at real, finished_at real, error text, result text)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def save(self, job: Job):
+        with self._connect() as conn:
+            conn.execute(
+                "insert or replace into jobs values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.job_id, job.kind, json.dumps(job.params), job.priority, job.status, job.created_at,
+                 job.started_at, job.finished_at, job.error, json.dumps(job.result) if job.result is not None else None),
+            )
+
+    def load(self, job_id: str) -> Job | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "select job_id, kind, params, priority, status, created_at, started_at, finished_at, error, result from jobs where job_id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return Job(
+            job_id=row[0], kind=row[1], params=json.loads(row[2]), priority=row[3], status=row[4], created_at=row[5],
+            started_at=row[6], finished_at=row[7], error=row[8], result=json.loads(row[9]) if row[9] else None,
+        )
+
+    def load_unfinished(self) -> list[Job]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "select job_id, kind, params, priority, created_at from jobs where status in (?, ?) order by created_at",
+                (QUEUED, RUNNING),
+            ).fetchall()
+        return [Job(job_id=row[0], kind=row[1], params=json.loads(row[2]), priority=row[3], created_at=row[4]) for row in rows]
+
+    def delete_finished_before(self, cutoff: float):
+        with self._connect() as conn:
+            conn.execute(f"delete from jobs where status in ({', '.join('?' * len(FINISHED_STATUSES))}) and finished_at < ?", (*FINISHED_STATUSES, cutoff))
+
+
+class JobQueue:
+    def __init__(self, handler, workers: int, max_depth: int, store_path: str | None = None, retention: int = 3600):
+        self.handler = handler
+        self.workers = workers
+        self.max_depth = max_depth
+        self.retention = retention
+        self.store = JobStore(store_path) if store_path else None
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._jobs = {}
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._stopping.clear()
+        if self.store:
+            # Jobs that were queued or mid-run when the process stopped are run again
+            for job in self.store.load_unfinished():
+                self._enqueue(job)
+            if self._depth:
+                logging.info(f"Restored {self._depth} unfinished jobs from {self.store.path}")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        # Sentinels sort ahead of every job, so workers exit after their current job and anything
+        # still queued stays persisted for the next start
+        for _ in self._threads:
+            self._queue.put((float("-inf"), next(self._sequence), None))
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    def persist(self, job: Job):
+        if self.store:
+            try:
+                self.store.save(job)
+            except Exception as e:
+                logging.error(f"Failed to persist job {job.job_id}: {str(e)}")
+
+    def _enqueue(self, job: Job, enforce_limit: bool = False):
+        with self._lock:
+            if enforce_limit and self._depth >= self.max_depth:
+                raise QueueFull(f"Job queue is full ({self.max_depth} jobs waiting)")
+            self._jobs[job.job_id] = job
+            self._depth += 1
+        self.persist(job)
+        self._queue.put((-job.priority, next(self._sequence), job.job_id))
+
+    def submit(self, kind: str, params: dict, priority: int = 0) -> Job:
+        self._prune()
+        job = Job(kind=kind, params=params, priority=priority)
+        self._enqueue(job, enforce_limit=True)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        job = self._jobs.get(job_id)
+        if job is None and self.store:
+            # Finished jobs from before a restart are only in the store
+            job = self.store.load(job_id)
+        return job
+
+    def cancel(self, job_id: str) -> Job | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return job
+            job.cancel_requested = True
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.finished_at = time.time()
+                self._depth -= 1
+        self.persist(job)
+        return job
+
+    def depth(self) -> int:
+        return self._depth
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_STATUSES and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+        if self.store and expired:
+            self.store.delete_finished_before(cutoff)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            _, _, job_id = self._queue.get()
+            if job_id is None:
+                return
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job.status != QUEUED:
+                    continue
+                job.status = RUNNING
+                job.started_at = time.time()
+                self._depth -= 1
+            self.persist(job)
+            STAGE_SECONDS.labels(stage="queue_wait").observe(job.started_at - job.created_at)
+
+            try:
+                # Handlers return the callback payload; a 'failed' payload marks the job failed
+                job.result = self.handler(job)
+                job.status = FAILED if (job.result or {}).get("status") == "failed" else COMPLETED
+                job.error = (job.result or {}).get("error")
+            except JobCancelled:
+                job.status = CANCELLED
+            except Exception as e:
+                logging.error(f"Job {job.job_id} failed: {str(e)}")
+                job.status = FAILED
+                job.error = str(e)
+            job.finished_at = time.time()
+            self.persist(job)
+            JOBS.labels(kind=job.kind, status=job.status).inc()
+            logging.info(f"Job {job.job_id} {job.status} in {job.finished_at - job.started_at:.1f}s")
@@ -0,0 +1,96 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from urllib.parse import quote, unquote
+
+import settings
+
+# Tables that are identical for every user on a given matchday. They are fetched once per
+# (season, matchday) and shared, instead of being re-queried for every lineup request.
+
+
+class MatchdayCache:
+    def __init__(self, ttl: int, cache_dir: str | None = None):
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def _path(self, key: tuple) -> str:
+        return os.path.join(self.cache_dir, *(quote(part, safe="") for part in key)) + ".pkl"
+
+    def _read_disk(self, key: tuple):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable league cache file for {key}: {str(e)}")
+            return None
+
+    def _write_disk(self, key: tuple, entry: tuple):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def _fresh(self, entry) -> bool:
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def get_or_load(self, season: str, matchday: str, table: str, loader):
+        key = (season, matchday, table)
+        entry = self._entries.get(key)
+        if self._fresh(entry):
+            return entry[1]
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given table; concurrent requests for the same round wait for it
+        with load_lock:
+            entry = self._entries.get(key)
+            if self._fresh(entry):
+                return entry[1]
+            entry = self._read_disk(key)
+            if not self._fresh(entry):
+                entry = (time.time(), loader())
+                self._write_disk(key, entry)
+                logging.info(f"League cache loaded {table} for {season} {matchday}")
+            self._entries[key] = entry
+            return entry[1]
+
+    def invalidate(self, matchday: str | None = None, season: str | None = None) -> int:
+        def matches(key):
+            return (season is None or key[0] == season) and (matchday is None or key[1] == matchday)
+
+        with self._lock:
+            keys = [key for key in self._entries if matches(key)]
+            for key in keys:
+                del self._entries[key]
+
+        removed = set(keys)
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if not name.endswith(".pkl"):
+                        continue
+                    path = os.path.join(root, name)
+                    key = tuple(unquote(part) for part in os.path.relpath(path, self.cache_dir)[:-len(".pkl")].split(os.sep))
+                    if matches(key):
+                        os.remove(path)
+                        removed.add(key)
+        logging.info(f"League cache invalidated {len(removed)} entries (season={season}, matchday={matchday})")
+        return len(removed)
+
+
+league_cache = MatchdayCache(ttl=settings.LEAGUE_CACHE_TTL, cache_dir=settings.LEAGUE_CACHE_DIR)
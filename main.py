@@ -1,190 +1,253 @@
-# Warning control
-import warnings
-warnings.filterwarnings('ignore')
-
-from crewai import Agent, Task, Crew, Process, LLM
-from crewai_tools import FileReadTool
-from crewai.tools import tool
-from google import genai
+import argparse
+import json
+import logging
+import multiprocessing
 import os
-from sqlalchemy import create_engine, text
-from google.cloud.sql.connector import Connector, IPTypes
-from crewai.tools import BaseTool
-
-# 1. Access keys from Codespaces Secrets
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-
-# 2. Define the LLM using CrewAI's native class
-# Note the provider prefix 'gemini/' which is required for LiteLLM routing
-my_llm = LLM(
-    model='gemini/gemini-2.5-flash',
-    api_key=GEMINI_API_KEY,
-    base_url="https://generativelanguage.googleapis.com",
-    temperature=0.7
-)
-
-class CloudSQLQueryTool(BaseTool):
-    name: str = "Cloud SQL Query Tool"
-    description: str = "Use this tool to query the Google Cloud SQL database. Input should be a raw SQL query."
-
-    def _run(self, query: str) -> str:
-        # Initialize Connector
-        connector = Connector()
-
-        def getconn():
-            conn = connector.connect(
-                os.environ.get("INSTANCE_CONNECTION_NAME"), # project:region:instance
-                "pg8000",
-                user=os.environ.get("DB_USER"),
-                password=os.environ.get("DB_PASS"),
-                db=os.environ.get("DB_NAME"),
-                ip_type=IPTypes.PUBLIC  # Or IPTypes.PRIVATE
-            )
-            return conn
-
-        # Create Engine
-        engine = create_engine("postgresql+pg8000://", creator=getconn)
-
-        with engine.connect() as conn:
-            result = conn.execute(text(query))
-            rows = result.fetchall()
-            return str(rows)
-
-# Usage
-cloud_sql_tool = CloudSQLQueryTool()
-
-ff_data_collection_agent = Agent(
-    role="Fantasy Football Data Collection Agent",
-    goal="Retrieve Fantasy Football data from relevant "
-    "data sources which will inform the fantasy football data analyst agent",
-    backstory=(
-        "Your job is to retrieve a set of pre-defined fantasy football related data. "
-        "These data sets include home team squad data for the current matchweek, "
-        "the real world fixtures for the current matchweek in the Premier League, "
-        "the current Premier League table standings, "
-        "the attacking and defending performance data for the current season of each player and club they play for found in the line ups, "
-        "the current injuries data for players in the Premier League. "
-    
-    ),
-    allow_delegation=False,
-    llm = my_llm,
-    tools=[cloud_sql_tool],
-    verbose=True
-)
-
-ff_data_analyst_agent = Agent(
-    role="Fantasy Football Data Analyst Agent",
-    goal="Analyse the lineup, real world fixture, current league table standings, team and player performance "
-    "data provided by the fantasy football data collection agent in order to recommend the best "
-    "line up for the Home team for that gameweek in order to beat the squad of the Away team on most goals scored and fewest goals conceded.",
-    backstory=(
-        "You are a fantasy football data analyst who aims to recommend the best lineup for the home "
-        "team for a given matchweek fixture. You will base your recommendation off of the squad of "
-        "the home team and the real world Premier League fixtures for that matchweek. "
-        "In addition to these data sets, you will also utilise the current Premier League table and "
-        "season player performance data for each player (and the clubs they play for) in the lineups to make the recommendation."
-    ),
-    allow_delegation=False,
-    llm = my_llm,
-    verbose=True
-)
-
-extract_data = Task(
-    description=(
-        "1. Extract home team squad data using the cloud_sql_tool via this SQL Query 'select t.api_player_id, t.name, p.position, te.name as team from teamsheets t left join players p on t.api_player_id = p.api_player_id left join teams te on p.teams_id = te.id where user_id = '1' and p.account_id = t.account_id ORDER BY position;' \n"
-        "2. Extract the current matchweeks fixture data using the cloud_sql_tool via this SQL Query 'select round, hteamid, hteamname, ateamid, ateamname from prem_fixtures where round = 'Regular Season - 35';' \n"
-        "3. Extract the player attacking stats data for each home team player using the cloud_sql_tool via this SQL Query 'SELECT api_player_id, name, injured, team_id, team_name, appearances, lineups, position, rating, shots_total, shots_on, goals_total, goals_assists, passes_key, passes_accuracy, dribbles_attempts, dribbles_success, fouls_drawn FROM player_statistics WHERE api_player_id IN (SELECT api_player_id FROM teamsheets WHERE user_id = '1');'\n"
-        "4. Extract the team defensive stats data for each home team players club using the cloud_sql_tool via this SQL Query 'select team_id, name, played_home, played_away, played_total, goals_against_home, goals_against_away, avg_goals_against_home, avg_goals_against_away, avg_goals_against_total, clean_sheets_home, clean_sheets_away from team_statistics WHERE team_id IN (SELECT id FROM teams where id IN (SELECT p.teams_id FROM teamsheets t LEFT JOIN players p ON t.api_player_id = p.api_player_id WHERE t.user_id = '1'));' \n"
-        "5. Extract the team attacking stats data for each home team players club using the cloud_sql_tool via this SQL Query 'select team_id, name, played_home, played_away, played_total, wins_home, wins_away, draws_home, draws_away, losses_home, losses_away goals_for_home, goals_for_away, avg_goals_for_home, avg_goals_for_away, avg_goals_for_total, failed_to_score_home, failed_to_score_away from team_statistics WHERE team_id IN (SELECT id FROM teams where id IN (SELECT p.teams_id FROM teamsheets t LEFT JOIN players p ON t.api_player_id = p.api_player_id WHERE t.user_id = '1'));' \n"
-        "6. Extract the player defensive stats data for each home team player via the api_player_id from the home team player using the cloud_sql_tool via this SQL Query 'select api_player_id, name, injured, team_id, team_name, appearances, lineups, position, rating, goals_conceded, tackles_total, tackles_blocks, tackles_interceptions, duels_total, duels_won, fouls_committed from player_statistics WHERE api_player_id IN (SELECT api_player_id FROM teamsheets WHERE user_id = '1' and position = 'Defender');' \n"
-        "7. Extract the goalkeeper stats data for each home team player using the cloud_sql_tool via this SQL Query 'select api_player_id, name, team_id, team_name, appearances, lineups, position, rating, goals_conceded, goals_saves, duels_total, duels_won FROM player_statistics WHERE api_player_id IN (SELECT api_player_id FROM teamsheets WHERE user_id = '1' and position = 'Goalkeeper');' \n"
-        "8. Extract the current injured players data for the Premier League from the home team lineup data using the cloud_sql_tool via this SQL Query 'select api_player_id, name, injured, team_id, team_name, position from player_statistics WHERE api_player_id IN (SELECT api_player_id FROM teamsheets WHERE user_id = '1');'. If a player is injured remove the player from the recommendation \n"
-        "9. Extract the current Premier League table using the cloud_sql_tool via this SQL Query 'select * from standings;' " 
-    ),
-    expected_output="A comprehensive set of data you can provide to the Fantasy Football Data Analyst Agent",
-    agent=ff_data_collection_agent,
-)
-
-analyse_data = Task(
-    description=(
-        "1. Analyse the lineup, real world fixture, league table, player and team attacking and defending stats data provided by the data collection agent /n"
-        "2. Use the rules of the fantasy football game here: /n"
-
-"On a ‘Match weekend’ your team will have a score calculated as follows: /n"
-
-"(i) any goals conceded during the relevant weekend by your goalkeeper and /n"
-
-"defenders will count against you even if you have all 5 players from the /n"
-
-"same team. For instance – if your goalkeeper and defenders are all Crystal /n"
-
-"Palace players and they concede 2 goals during their weekend match then /n"
-
-"all 5 players will count the 2 goals conceded against them hence arriving at /n"
-
-"a total of 10. /n"
-
-"(ii) once you have counted up the total number of goals conceded by your /n"
-
-"goalkeeper and defenders you divide that total by 5 to /n"
-
-"calculate how many goals your team has conceded. Using the example /n"
-
-"above your team will have obviously conceded 2 goals. [10 ÷ 5 = 2] /n"
-
-"(iii) if your defence concedes 11-14 goals in total that will still equate to 2 /n"
-
-"goals conceded by your team, 15-19 will equate to 3 goals etc. and so on. /n"
-
-"(iv) your team will then total the number of goals scored by any of your /n"
-
-"players deemed to have played in your 1st eleven for that /n"
-
-"weekend/midweek. The organiser will try and verify goal scorers on at /n"
-
-"least two sites if there are any queries as to who scored. /n"
-
-"(v) you then subtract the number of goals conceded from the number of goals /n"
-
-"scored to calculate what your team has scored that weekend. For instance /n"
-
-"– your defence has conceded 2 goals but 3 of your players have scored. /n"
-
-"(vi) players do not have to have played a full game to count as having played /n"
-
-"but any goals conceded during the match will count against defenders /n"
-
-"even if they only come on for the last minute of the match. /n"
-
-"(vii) if an own goal is scored by your goalkeeper or defenders there is no /n"
-
-"added disadvantage to your team. /n"
-
-"(viii) your team will also concede one extra goal for every position in defence /n"
-
-"(goalkeeper and 4 defenders) that you fail to field. /n"
-
-"(ix) On a 'match weekend' your team will have a score by the API calculated as follows. /n"
-"The organiser will use the details issued or standing on the morning after a set of matches have been played /n"
-"and this will stand even if any other official 'dubious goals' committee credit someone else as scoring that goal at /n"
-"a later date. Due to the way the fantasy football league is run there will be no facility to change goal scorers and any /n"
-"subsequent match scores due to this process. /n"
-
-        "to recommend the best lineup. /n"
-        "3. In the player attacking stats data set, the goals_total column is the total amount of goals the player has scored, goals_assists is the total amount of assists the player has provided. /n"
-        "4. Analyse each player in the Home team lineup individually taking into consideration thier individual and club attacking and defending stats, the real world fixture, league table and injury data. /n"
-    ),
-    expected_output="Recommendation of the Home Team lineup (1 Goalkeeper, 4 Defenders, 4 Midfielders, 2 Strikers) the fantasy football player should select for the gameweek in order to beat the Away team squad based on all data available, game rules and ensuring the player is not injured and makes a high number of appearances for his team. Ensure the players picked are only players from the home team lineup data even if there are no stats available attacking and defending wise for an individual player. Provide a summary of the logic used.",
-    agent=ff_data_analyst_agent,
-)
-
-crew = Crew(
-    agents=[ff_data_collection_agent, ff_data_analyst_agent],
-    tasks=[extract_data, analyse_data],
-    verbose=False
-)
-
-result = crew.kickoff()
-
-from IPython.display import Markdown
-Markdown(result.raw)
\ No newline at end of file
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+import settings
+from database import dispose_engine
+from prefetch import prefetch_batch_data
+from queries import execute
+
+# Offline batch runner that precomputes lineup recommendations, e.g. overnight before a matchday
+# opens. The parent process prefetches users' data in chunks with the set-based batch queries (the
+# league tables and player features are read once for the whole run) and fans the per-user
+# analysis out to a pool of worker processes, each running the same pipeline as the API
+# (pipeline.analyse_user). LLM calls from every worker share one rate limit. Each result is
+# appended to a JSONL file as soon as it finishes, so an interrupted run picks up where it left off
+# when started again with the same output file.
+#
+#   python main.py --matchday "Regular Season - 35" --users 1 2 3
+#   python main.py --matchday "Regular Season - 35" --all-users --workers 8 --llm-rpm 120
+#
+# With RECOMMENDATION_CACHE_DIR pointing at the service's cache directory, the service answers
+# these users from the cache afterwards without calling the LLM.
+
+
+class LLMRateLimiter:
+    # Spaces LLM calls at least 60 / per_minute seconds apart across every worker process. Created
+    # in the parent and handed to the workers when they start.
+
+    def __init__(self, per_minute: float, context):
+        self.interval = 60.0 / per_minute
+        self._lock = context.Lock()
+        self._next_slot = context.Value("d", 0.0, lock=False)
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot.value)
+            self._next_slot.value = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+def init_worker(rate_limiter: LLMRateLimiter | None, stub_llm_latency: float | None):
+    # Runs once in each worker process, so crewai and the LLM client are set up once per worker
+    import agents
+
+    if stub_llm_latency is not None:
+        from benchmark import make_stub_llm
+        agents.use_llm(make_stub_llm(stub_llm_latency))
+    if rate_limiter is not None:
+        agents.limit_llm_calls(rate_limiter.acquire)
+    agents.warm_up()
+
+
+def analyse(prefetched, team_name: str | None) -> dict:
+    # Runs in a worker process on data the parent already fetched; the workers never query the database
+    from pipeline import analyse_user
+    return analyse_user(prefetched.user_id, team_name, lambda: prefetched)
+
+
+def resolve_users(args) -> list[str]:
+    if args.users:
+        return list(dict.fromkeys(str(user_id) for user_id in args.users))
+    if args.account_id:
+        result = execute("account_users", {"account_id": args.account_id, "season": settings.SEASON})
+    else:
+        result = execute("season_users", {"season": settings.SEASON})
+    return sorted({str(row[0]) for row in result.rows}, key=lambda user_id: (len(user_id), user_id))
+
+
+def read_finished(path: str, matchday: str, retry_fallbacks: bool = False) -> set[str]:
+    # Users already completed for this matchday by an earlier run writing to the same file. With
+    # retry_fallbacks, users who only got the optimizer's summary (the LLM failed) are run again.
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of a run killed mid-write
+                continue
+            if record.get("matchday") != matchday or record.get("status") != "completed":
+                continue
+            if retry_fallbacks and record.get("explanation_source") != "llm":
+                continue
+            finished.add(str(record.get("user_id")))
+    return finished
+
+
+def open_output(path: str):
+    output = open(path, "a+", encoding="utf-8")
+    # Start on a fresh line if a killed run left a partial one behind
+    if output.tell() > 0:
+        output.seek(output.tell() - 1)
+        if output.read(1) != "\n":
+            output.write("\n")
+    return output
+
+
+class RunStats:
+    def __init__(self, total: int, skipped: int):
+        self.total = total
+        self.skipped = skipped
+        self.started = time.perf_counter()
+        self.statuses = {}
+        self.user_seconds = []
+        self.cached = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def done(self) -> int:
+        return sum(self.statuses.values())
+
+    def add(self, record: dict):
+        self.statuses[record["status"]] = self.statuses.get(record["status"], 0) + 1
+        self.cached += bool(record.get("cached"))
+        timings = record.get("timings") or {}
+        if "total" in timings.get("stages", {}):
+            self.user_seconds.append(timings["stages"]["total"])
+        self.prompt_tokens += timings.get("prompt_tokens", 0)
+        self.completion_tokens += timings.get("completion_tokens", 0)
+
+    def per_minute(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.done / elapsed * 60 if elapsed else 0.0
+
+    def report(self) -> dict:
+        seconds = np.array(self.user_seconds)
+        return {
+            "users": self.total,
+            "skipped": self.skipped,
+            "outcomes": dict(self.statuses),
+            "wall_seconds": round(time.perf_counter() - self.started, 1),
+            "users_per_minute": round(self.per_minute(), 1),
+            "user_seconds": {
+                "mean": round(float(seconds.mean()), 2),
+                "p50": round(float(np.percentile(seconds, 50)), 2),
+                "p95": round(float(np.percentile(seconds, 95)), 2),
+                "max": round(float(seconds.max()), 2),
+            } if seconds.size else {},
+            "cached": self.cached,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+def print_report(report: dict):
+    print(f"\nUsers: {report['users']} ({report['skipped']} already done, skipped)")
+    print(f"Outcomes: {report['outcomes']} in {report['wall_seconds']}s ({report['users_per_minute']} users/min)")
+    print(f"Seconds per user: {report['user_seconds']}")
+    print(f"Recommendation cache hits: {report['cached']}")
+    print(f"LLM tokens: {report['prompt_tokens']} prompt, {report['completion_tokens']} completion")
+
+
+def run(args) -> dict:
+    user_ids = resolve_users(args)
+    finished = read_finished(args.output, args.matchday, args.retry_fallbacks)
+    pending = [user_id for user_id in user_ids if user_id not in finished]
+    stats = RunStats(total=len(user_ids), skipped=len(user_ids) - len(pending))
+    logging.info(f"{len(pending)} of {len(user_ids)} users to analyse for {args.matchday}, writing to {args.output}")
+
+    # Spawned rather than forked: the parent holds a connection pool and prefetch threads
+    context = multiprocessing.get_context("spawn")
+    rate_limiter = LLMRateLimiter(args.llm_rpm, context) if args.llm_rpm else None
+    pool = ProcessPoolExecutor(
+        max_workers=args.workers, mp_context=context, initializer=init_worker, initargs=(rate_limiter, args.stub_llm)
+    )
+    inflight = {}
+
+    def write(record: dict):
+        record.setdefault("matchday", args.matchday)
+        output.write(json.dumps(record, default=str) + "\n")
+        output.flush()
+        stats.add(record)
+        if stats.done % args.progress_every == 0 or stats.done == len(pending):
+            logging.info(f"{stats.done}/{len(pending)} users done ({stats.per_minute():.1f} users/min): {stats.statuses}")
+
+    def collect(block_until: int):
+        # Record finished users until at most block_until are still in flight
+        while len(inflight) > block_until:
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                user_id = inflight.pop(future)
+                try:
+                    write(future.result())
+                except Exception as e:
+                    write({"status": "failed", "user_id": user_id, "error": str(e)})
+
+    output = open_output(args.output)
+    try:
+        for start in range(0, len(pending), args.chunk_size):
+            chunk = pending[start:start + args.chunk_size]
+            try:
+                prefetched = prefetch_batch_data(chunk, args.matchday)
+            except Exception as e:
+                logging.error(f"Prefetch failed for {len(chunk)} users: {str(e)}")
+                for user_id in chunk:
+                    write({"status": "failed", "user_id": user_id, "error": f"Prefetch failed: {str(e)}"})
+                continue
+            for user_id in chunk:
+                inflight[pool.submit(analyse, prefetched[user_id], args.team_name)] = user_id
+            # Keep a chunk's worth queued so the workers stay busy while the next chunk is prefetched
+            collect(block_until=args.workers)
+        collect(block_until=0)
+    except KeyboardInterrupt:
+        logging.warning(f"Interrupted; run again with --output {args.output} to resume")
+        pool.shutdown(wait=False, cancel_futures=True)
+    else:
+        pool.shutdown()
+    finally:
+        output.close()
+        dispose_engine()
+    return stats.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute lineup recommendations for many users, writing results to JSONL")
+    parser.add_argument("--matchday", required=True, help="e.g. 'Regular Season - 35'")
+    users = parser.add_mutually_exclusive_group(required=True)
+    users.add_argument("--users", nargs="+", help="user_ids to analyse")
+    users.add_argument("--all-users", action="store_true", help="Every user with a squad this season (see SEASON)")
+    parser.add_argument("--account-id", help="With --all-users, only users in this account")
+    parser.add_argument("--team-name", help="Passed through to each result, as in API requests")
+    parser.add_argument("--output", default="recommendations.jsonl", help="JSONL file to append to; users already completed in it are skipped")
+    parser.add_argument("--retry-fallbacks", action="store_true", help="Also rerun users whose completed result used the optimizer summary because the LLM failed")
+    parser.add_argument("--workers", type=int, default=settings.BATCH_WORKERS, help="Worker processes analysing users concurrently")
+    parser.add_argument("--llm-rpm", type=float, default=0, help="Maximum LLM calls per minute across all workers (0 for no limit)")
+    parser.add_argument("--chunk-size", type=int, default=100, help="Users prefetched per set-based batch query")
+    parser.add_argument("--progress-every", type=int, default=10, help="Log progress every N users")
+    parser.add_argument("--stub-llm", type=float, metavar="SECONDS", help="Dry run with benchmark.py's stub LLM, sleeping this long per call")
+    parser.add_argument("--json-output", help="Also write the run stats to this file")
+    args = parser.parse_args()
+    if args.account_id and not args.all_users:
+        parser.error("--account-id needs --all-users")
+
+    logging.basicConfig(level=logging.INFO)
+    report = run(args)
+    print_report(report)
+    if args.json_output:
+        with open(args.json_output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
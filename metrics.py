@@ -0,0 +1,133 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Prometheus metrics for the lineup pipeline plus a per-job timing breakdown. span() and
+# query_span() time a stage or SQL query and observe it in the matching histogram; while a job is
+# tracked in the current context (track_job()) the same measurements are also added to that job's
+# JobTimings, which is returned in the callback payload. Thread pools only see the job when work is
+# submitted through contextvars.copy_context().run (see prefetch.py).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_SECONDS = Histogram("lineup_stage_seconds", "Time spent in each stage of a lineup run", ["stage"], buckets=LATENCY_BUCKETS)
+SQL_QUERY_SECONDS = Histogram("lineup_sql_query_seconds", "SQL query latency by query label", ["query"], buckets=LATENCY_BUCKETS)
+LLM_CALL_SECONDS = Histogram("lineup_llm_call_seconds", "LLM call latency", ["model"], buckets=LATENCY_BUCKETS)
+LLM_CALL_FAILURES = Counter("lineup_llm_call_failures", "LLM calls that raised", ["model"])
+LLM_TOKENS = Counter("lineup_llm_tokens", "LLM tokens used", ["model", "kind"])
+CALLBACK_POST_SECONDS = Histogram("lineup_callback_post_seconds", "Latency of each webhook POST attempt", buckets=LATENCY_BUCKETS)
+CALLBACKS = Counter("lineup_callbacks", "Callback deliveries by outcome", ["outcome"])
+JOBS = Counter("lineup_jobs", "Finished jobs by kind and status", ["kind", "status"])
+JOB_QUEUE_DEPTH = Gauge("lineup_job_queue_depth", "Jobs waiting in the queue")
+
+_current = contextvars.ContextVar("lineup_job_timings", default=None)
+
+
+class JobTimings:
+    # Shared by the job's worker thread and the prefetch / event bus threads, hence the lock
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.queries = {}
+        self.llm_calls = []
+
+    def add_stage(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_query(self, label: str, seconds: float):
+        with self._lock:
+            count, total = self.queries.get(label, (0, 0.0))
+            self.queries[label] = (count + 1, total + seconds)
+
+    def add_llm_call(self, model: str | None, seconds: float | None, prompt_tokens: int, completion_tokens: int, failed: bool = False):
+        with self._lock:
+            self.llm_calls.append({
+                "model": model,
+                "seconds": round(seconds, 3) if seconds is not None else None,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "failed": failed,
+            })
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "stages": {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+                "sql_queries": {label: {"count": count, "seconds": round(total, 4)} for label, (count, total) in self.queries.items()},
+                "llm_calls": list(self.llm_calls),
+                "prompt_tokens": sum(call["prompt_tokens"] for call in self.llm_calls),
+                "completion_tokens": sum(call["completion_tokens"] for call in self.llm_calls),
+            }
+
+
+@contextmanager
+def track_job():
+    timings = JobTimings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+def current_timings() -> JobTimings | None:
+    return _current.get()
+
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage=stage).observe(elapsed)
+        timings = _current.get()
+        if timings is not None:
+            timings.add_stage(stage, elapsed)
+
+
+@contextmanager
+def query_span(label: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        SQL_QUERY_SECONDS.labels(query=label).observe(elapsed)
+        timings = _current.get()
+        if timings is not None:
+            timings.add_query(label, elapsed)
+
+
+def _token_count(usage: dict, *keys: str) -> int:
+    # Providers report usage under different keys (OpenAI-style, Gemini, Anthropic)
+    for key in keys:
+        if usage.get(key):
+            return int(usage[key])
+    return 0
+
+
+def record_llm_call(model: str | None, seconds: float | None, usage: dict | None, failed: bool = False):
+    model_label = model or "unknown"
+    usage = usage or {}
+    prompt_tokens = _token_count(usage, "prompt_tokens", "prompt_token_count", "input_tokens")
+    completion_tokens = _token_count(usage, "completion_tokens", "candidates_token_count", "output_tokens")
+    if seconds is not None:
+        LLM_CALL_SECONDS.labels(model=model_label).observe(seconds)
+    if failed:
+        LLM_CALL_FAILURES.labels(model=model_label).inc()
+    LLM_TOKENS.labels(model=model_label, kind="prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(model=model_label, kind="completion").inc(completion_tokens)
+    timings = _current.get()
+    if timings is not None:
+        timings.add_llm_call(model, seconds, prompt_tokens, completion_tokens, failed)
+
+
+def render_latest() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,263 @@
+import itertools
+import logging
+import math
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from feature_store import DEFAULT_PLAY_PROBABILITY, fixture_lookup, fixture_rates
+from prefetch import PrefetchedData
+
+# Deterministic lineup optimizer implementing the game's scoring rules:
+#   score = goals scored by the first XI
+#           - floor(goals conceded by the goalkeeper and 4 defenders / 5)
+#           - 1 per defensive slot (goalkeeper or defender) left unfilled
+# Every formation-valid, injury-filtered lineup in the squad is scored on expected values and
+# the best top_k are returned. The LLM is only used afterwards to explain the pick. Player rates
+# (play probability, expected goals, fixture goals for and against) come from the matchday's
+# feature table (feature_store.py), the same values the analyst is sent.
+
+POSITION_GROUPS = {
+    "Goalkeeper": "G",
+    "Defender": "D",
+    "Midfielder": "M",
+    "Attacker": "F",
+    "Striker": "F",
+    "Forward": "F",
+}
+DEFENSIVE_SLOTS = {"G": 1, "D": 4}
+SUPPORTED_FORMATIONS = ("4-4-2", "4-3-3")
+# Goals conceded per club per match above this are treated as negligible when building distributions
+MAX_GOALS_PER_MATCH = 12
+
+
+@dataclass
+class PlayerProjection:
+    api_player_id: object
+    name: str
+    position: str
+    group: str
+    team: str | None
+    team_id: object
+    opponent: str | None
+    venue: str | None
+    play_probability: float
+    expected_goals: float
+    expected_team_scored: float
+    expected_team_conceded: float
+
+    def as_dict(self) -> dict:
+        return {
+            "api_player_id": self.api_player_id,
+            "name": self.name,
+            "position": self.position,
+            "team": self.team,
+            "opponent": self.opponent,
+            "venue": self.venue,
+            "play_probability": round(self.play_probability, 3),
+            "expected_goals": round(self.expected_goals, 3),
+            "expected_team_conceded": round(self.expected_team_conceded, 3),
+        }
+
+
+@dataclass
+class LineupRecommendation:
+    formation: str
+    players: list[PlayerProjection]
+    unfilled_defensive_slots: int
+    expected_goals_for: float
+    expected_goals_against: float
+
+    @property
+    def expected_score(self) -> float:
+        return self.expected_goals_for - self.expected_goals_against
+
+    def as_dict(self) -> dict:
+        return {
+            "formation": self.formation,
+            "players": [player.as_dict() for player in self.players],
+            "unfilled_defensive_slots": self.unfilled_defensive_slots,
+            "expected_goals_for": round(self.expected_goals_for, 3),
+            "expected_goals_against": round(self.expected_goals_against, 3),
+            "expected_score": round(self.expected_score, 3),
+        }
+
+    def summary(self) -> str:
+        lines = [f"Recommended {self.formation} lineup (expected score {self.expected_score:+.2f}):"]
+        for player in self.players:
+            fixture = f"{player.venue} v {player.opponent}" if player.opponent else "no fixture"
+            lines.append(
+                f"- {player.position}: {player.name} ({player.team}, {fixture}) - expected goals {player.expected_goals:.2f}, "
+                f"club expected to concede {player.expected_team_conceded:.2f}, plays {player.play_probability:.0%} of matches"
+            )
+        if self.unfilled_defensive_slots:
+            lines.append(f"- {self.unfilled_defensive_slots} defensive slot(s) unfilled: +1 goal conceded each")
+        return "\n".join(lines)
+
+
+def _is_injured(value) -> bool:
+    return str(value).strip().lower() in {"true", "t", "1", "yes", "y"}
+
+
+def _number(value, default: float = 0.0) -> float:
+    try:
+        return default if value is None else float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_formation(formation: str) -> dict:
+    defenders, midfielders, forwards = (int(part) for part in formation.split("-"))
+    return {"G": 1, "D": defenders, "M": midfielders, "F": forwards}
+
+
+def team_rates(team: dict, opponent: dict, venue: str) -> tuple[float, float]:
+    # Expected goals for and against the club in this fixture, from the two clubs' team_statistics rows
+    other = "away" if venue == "home" else "home"
+    return fixture_rates(
+        _number(team.get(f"avg_goals_for_{venue}")), _number(team.get(f"avg_goals_against_{venue}")),
+        _number(opponent.get(f"avg_goals_for_{other}")), _number(opponent.get(f"avg_goals_against_{other}")),
+    )
+
+
+def project_players(data: PrefetchedData) -> list[PlayerProjection]:
+    features = {row["api_player_id"]: row for row in data.player_features.as_dicts()}
+    stats = {row["api_player_id"]: row for row in data.player_attacking.as_dicts()}
+    injured = {row["api_player_id"] for row in data.player_attacking.as_dicts() + data.injuries.as_dicts() if _is_injured(row.get("injured"))}
+    # Only for squad players missing from the feature table (no player_statistics row)
+    team_statistics = {str(row["team_id"]): row for row in data.team_defensive.as_dicts()}
+    for row in data.team_attacking.as_dicts():
+        team_statistics.setdefault(str(row["team_id"]), {}).update(row)
+    fixtures = fixture_lookup(data.fixtures)
+
+    projections = []
+    for player in data.squad.as_dicts():
+        group = POSITION_GROUPS.get(player["position"])
+        if group is None or player["api_player_id"] in injured:
+            continue
+        feature = features.get(player["api_player_id"])
+        if feature is not None:
+            # Players whose club has no fixture this round cannot score or concede; leave them out
+            if feature["venue"] is None:
+                continue
+            stat = stats[player["api_player_id"]]
+            team_id, team, opponent_name, venue = stat["team_id"], stat["team_name"], feature["opponent"], feature["venue"]
+            play_probability, expected_goals = _number(feature["play_probability"]), _number(feature["expected_goals"])
+            goals_for, goals_against = _number(feature["fixture_goals_for"]), _number(feature["fixture_goals_against"])
+        else:
+            fixture = fixtures.get(str(player["team_id"]))
+            if fixture is None:
+                continue
+            opponent_id, opponent_name, venue = fixture
+            team_id, team = player["team_id"], player.get("team")
+            goals_for, goals_against = team_rates(team_statistics.get(str(team_id), {}), team_statistics.get(str(opponent_id), {}), venue)
+            play_probability, expected_goals = DEFAULT_PLAY_PROBABILITY, 0.0
+        projections.append(PlayerProjection(
+            api_player_id=player["api_player_id"],
+            name=player["name"],
+            position=player["position"],
+            group=group,
+            team=team,
+            team_id=team_id,
+            opponent=opponent_name,
+            venue=venue,
+            play_probability=play_probability,
+            expected_goals=expected_goals,
+            expected_team_scored=goals_for,
+            expected_team_conceded=goals_against,
+        ))
+    return projections
+
+
+def _poisson_pmf(rate: float) -> np.ndarray:
+    pmf = np.zeros(MAX_GOALS_PER_MATCH + 1)
+    if rate <= 0:
+        pmf[0] = 1.0
+        return pmf
+    k = np.arange(MAX_GOALS_PER_MATCH + 1)
+    log_factorials = np.array([math.lgamma(i + 1) for i in k])
+    pmf = np.exp(k * math.log(rate) - rate - log_factorials)
+    return pmf / pmf.sum()
+
+
+def _expected_bucketed_conceded(defence: list[PlayerProjection], pmf_cache: dict) -> float:
+    # Distribution of the summed goals conceded by the fielded goalkeeper and defenders. Players at the
+    # same club concede the same goals, so each club contributes k * X with X its goals against and k
+    # the number of its players that actually play (each independently with their play_probability).
+    total = np.array([1.0])
+    by_team = {}
+    for player in defence:
+        by_team.setdefault(str(player.team_id), []).append(player)
+    for players in by_team.values():
+        club_pmf = pmf_cache.setdefault(players[0].expected_team_conceded, _poisson_pmf(players[0].expected_team_conceded))
+        playing = np.array([1.0])
+        for player in players:
+            playing = np.convolve(playing, [1 - player.play_probability, player.play_probability])
+        contribution = np.zeros(len(players) * MAX_GOALS_PER_MATCH + 1)
+        for k, probability in enumerate(playing):
+            if k == 0:
+                contribution[0] += probability
+            else:
+                contribution[::k][:len(club_pmf)] += probability * club_pmf
+        total = np.convolve(total, contribution)
+
+    buckets = np.arange(len(total)) // 5
+    # A picked defender who does not play leaves that slot unfielded: +1 goal each
+    not_fielded = sum(1 - player.play_probability for player in defence)
+    return float(total @ buckets) + not_fielded
+
+
+def _combinations(indexes: list[int], size: int) -> np.ndarray:
+    size = min(size, len(indexes))
+    combinations = list(itertools.combinations(indexes, size))
+    return np.array(combinations, dtype=np.intp).reshape(len(combinations), size)
+
+
+def optimise_lineup(data: PrefetchedData, top_k: int = 5) -> list[LineupRecommendation]:
+    started = time.perf_counter()
+    # Fixed player order, so lineups with equal expected scores are broken the same way whatever
+    # order the database returned the squad in
+    projections = sorted(project_players(data), key=lambda player: str(player.api_player_id))
+    by_group = {group: [i for i, p in enumerate(projections) if p.group == group] for group in "GDMF"}
+    expected_goals = np.array([p.expected_goals for p in projections])
+
+    formations = [data.formation_name] if data.formation_name in SUPPORTED_FORMATIONS else list(SUPPORTED_FORMATIONS)
+
+    # The defence (goalkeeper + 4 defenders) is shared by every formation, so score each distinct one once
+    goalkeepers = _combinations(by_group["G"], DEFENSIVE_SLOTS["G"])
+    defenders = _combinations(by_group["D"], DEFENSIVE_SLOTS["D"])
+    defences = [np.concatenate([g, d]) for g, d in itertools.product(goalkeepers, defenders)]
+    unfilled = sum(DEFENSIVE_SLOTS.values()) - (goalkeepers.shape[1] + defenders.shape[1])
+    pmf_cache = {}
+    defence_conceded = np.array([_expected_bucketed_conceded([projections[i] for i in d], pmf_cache) for d in defences]) + unfilled
+    defence_goals = np.array([expected_goals[d].sum() for d in defences])
+
+    candidates = []
+    for formation in formations:
+        slots = parse_formation(formation)
+        midfielders = _combinations(by_group["M"], slots["M"])
+        forwards = _combinations(by_group["F"], slots["F"])
+        # Attack score for every (midfield, forward line) pairing, then every defence against every attack
+        attack_goals = (expected_goals[midfielders].sum(axis=1)[:, None] + expected_goals[forwards].sum(axis=1)[None, :]).ravel()
+        scores = (defence_goals - defence_conceded)[:, None] + attack_goals[None, :]
+        flat = scores.ravel()
+        best = np.argpartition(-flat, min(top_k, flat.size) - 1)[:top_k] if flat.size > top_k else np.arange(flat.size)
+        for index in best:
+            d, a = divmod(int(index), attack_goals.size)
+            m, f = divmod(a, forwards.shape[0])
+            picked = list(defences[d]) + list(midfielders[m]) + list(forwards[f])
+            candidates.append(LineupRecommendation(
+                formation=formation,
+                players=[projections[i] for i in picked],
+                unfilled_defensive_slots=unfilled,
+                expected_goals_for=float(defence_goals[d] + attack_goals[a]),
+                expected_goals_against=float(defence_conceded[d]),
+            ))
+
+    candidates.sort(key=lambda lineup: lineup.expected_score, reverse=True)
+    logging.info(
+        f"Optimizer scored lineups for user_id: {data.user_id} from {len(projections)} available players "
+        f"in {(time.perf_counter() - started) * 1000:.1f}ms"
+    )
+    return candidates[:top_k]
@@ -0,0 +1,110 @@
+import logging
+
+import settings
+from agents import PROMPT_VERSION, build_analysis_crew
+from job_events import publish, scope
+from job_queue import JobCancelled
+from metrics import span, track_job
+from optimizer import optimise_lineup
+from prefetch import PrefetchedData, load_data_dictionary
+from recommendation_cache import recommendation_cache, fingerprint
+from serialization import encode_datasets, encode_raw, compact_data_dictionary, log_prompt_savings
+
+# One user's lineup analysis: recommendation cache, optimizer, prompt encoding and the analyst crew.
+# Shared by the API (fast_api.py) and the offline batch runner (main.py), whose spawned workers
+# import this module rather than the app with its job queue, callback dispatcher and executors.
+
+# Data dictionary handed to the analyst alongside the prefetched data
+data_dictionary = load_data_dictionary()
+
+def run_lineup_analysis(prefetched: PrefetchedData, team_name: str) -> dict:
+    user_id, matchday = prefetched.user_id, prefetched.matchday
+
+    # Identical inputs (squad, fixtures, injuries, stats, prompt version) give the stored result straight back
+    with span("recommendation_cache"):
+        cache_key = fingerprint(prefetched, PROMPT_VERSION)
+        recommendation = recommendation_cache.get(cache_key)
+    if recommendation is not None:
+        logging.info(f"Recommendation cache hit for user_id: {user_id}")
+        publish("cache_hit")
+        return {
+            "status": "completed",
+            "user_id": user_id,
+            "matchday": matchday,
+            "team_name": team_name,
+            **recommendation,
+            "cached": True
+        }
+
+    # Pick the lineup deterministically; the LLM only explains it
+    with span("optimizer"):
+        candidates = optimise_lineup(prefetched, top_k=settings.OPTIMIZER_TOP_K)
+    best_lineup = candidates[0]
+    publish("optimizer", {"candidates": [candidate.as_dict() for candidate in candidates]})
+
+    # Compact columnar prompt data, with only the dictionary entries for the columns actually sent
+    with span("prompt_encoding"):
+        prompt_data, sent_columns = encode_datasets(prefetched.datasets())
+        prompt_dictionary = compact_data_dictionary(data_dictionary, sent_columns)
+        if settings.PROMPT_SIZE_LOGGING:
+            log_prompt_savings(f"user_id: {user_id}", data_dictionary + encode_raw(prefetched.datasets()), prompt_dictionary + prompt_data)
+
+    with span("crew_build"):
+        crew = build_analysis_crew(prompt_dictionary, matchday, prompt_data, best_lineup.summary())
+
+    # Kickoff orchestration. If Gemini is slow or down the optimizer's own summary is sent instead.
+    # With LLM_STREAM on, the analyst's tokens are published as they arrive (see agents.py).
+    publish("analysis_started")
+    try:
+        with span("crew_kickoff"):
+            result_text = str(crew.kickoff().raw)
+        explanation_source = "llm"
+    except Exception as llm_err:
+        logging.warning(f"LLM explanation failed for user {user_id}, sending optimizer summary: {str(llm_err)}")
+        result_text = best_lineup.summary()
+        explanation_source = "optimizer"
+    publish("analysis_completed", {"explanation_source": explanation_source})
+
+    recommendation = {
+        "result": result_text,
+        "lineup": best_lineup.as_dict(),
+        "explanation_source": explanation_source
+    }
+    # Optimizer-only fallbacks are not cached so the next request tries the LLM again
+    if explanation_source == "llm":
+        recommendation_cache.put(cache_key, recommendation)
+
+    # Outbound Payload back to Ruby on Rails
+    payload = {
+        "status": "completed",
+        "user_id": user_id,
+        "matchday": matchday,
+        "team_name": team_name,
+        **recommendation,
+        "cached": False
+    }
+    return payload
+
+def failed_payload(user_id: str, error: Exception) -> dict:
+    logging.error(f"Crew failed for user {user_id}: {str(error)}")
+    return {
+        "status": "failed",
+        "user_id": user_id,
+        "error": str(error)
+    }
+
+def analyse_user(user_id: str, team_name: str, load) -> dict:
+    # Runs one user's analysis with its per-stage timing breakdown added to the payload
+    with track_job() as timings, scope(user_id=user_id):
+        try:
+            with span("total"):
+                with span("prefetch"):
+                    prefetched = load()
+                publish("data_fetched", {"datasets": {label: len(result.rows) for label, result in prefetched.datasets()}})
+                payload = run_lineup_analysis(prefetched, team_name)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            payload = failed_payload(user_id, e)
+    payload["timings"] = timings.as_dict()
+    return payload
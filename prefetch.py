@@ -0,0 +1,202 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
+
+import settings
+from feature_store import feature_store, MatchdayFeatures
+from league_cache import league_cache
+from queries import QueryResult, execute
+
+# The fixed data set the analyst needs for one user and matchday. These used to be issued one at a
+# time by the data collection agent; they are fully determined by user_id, matchday and the season
+# so we run them directly, in parallel, as named queries from the registry in queries.py. Player
+# and team statistics are each read once per matchday (the player feature table, refreshed
+# incrementally, and the cached league-wide team_statistics) and the per-user views are sliced
+# from them in memory.
+
+# Per-user data sets, each returned under its registry name
+PREFETCH_QUERIES = ("formation", "squad")
+
+# The same per-user data sets for many users at once: one set-based query per table, with the
+# owning user_id as the first column so rows can be split back out per user.
+BATCH_QUERIES = {"formation": "batch_formation", "squad": "batch_squad"}
+
+# League-wide tables, identical for every user on a matchday and served from league_cache
+LEAGUE_QUERIES = ("fixtures", "team_statistics", "standings")
+
+# Per-user views of the feature table; the same columns the per-user player_statistics queries returned
+PLAYER_ATTACKING_COLUMNS = [
+    "api_player_id", "name", "injured", "team_id", "team_name", "appearances", "lineups", "position", "rating",
+    "shots_total", "shots_on", "goals_total", "goals_assists", "passes_key", "passes_accuracy", "dribbles_attempts",
+    "dribbles_success", "fouls_drawn",
+]
+PLAYER_DEFENSIVE_COLUMNS = [
+    "api_player_id", "name", "injured", "team_id", "team_name", "appearances", "lineups", "position", "rating",
+    "goals_conceded", "tackles_total", "tackles_blocks", "tackles_interceptions", "duels_total", "duels_won", "fouls_committed",
+]
+GOALKEEPER_COLUMNS = [
+    "api_player_id", "name", "team_id", "team_name", "appearances", "lineups", "position", "rating", "goals_conceded",
+    "goals_saves", "duels_total", "duels_won",
+]
+INJURY_COLUMNS = ["api_player_id", "name", "injured", "team_id", "team_name", "position"]
+PLAYER_FEATURE_COLUMNS = [
+    "api_player_id", "venue", "opponent", "play_probability", "start_rate", "goals_per_appearance",
+    "opponent_goals_conceded", "fixture_goals_for", "fixture_goals_against", "expected_goals",
+]
+
+# Per-user views of team_statistics (the squad's clubs and their opponents), sliced in memory from
+# the cached league-wide table
+TEAM_DEFENSIVE_COLUMNS = [
+    "team_id", "name", "played_home", "played_away", "played_total", "goals_against_home", "goals_against_away",
+    "avg_goals_against_home", "avg_goals_against_away", "avg_goals_against_total", "clean_sheets_home", "clean_sheets_away",
+]
+TEAM_ATTACKING_COLUMNS = [
+    "team_id", "name", "played_home", "played_away", "played_total", "wins_home", "wins_away", "draws_home", "draws_away",
+    "losses_home", "losses_away", "goals_for_home", "goals_for_away", "avg_goals_for_home", "avg_goals_for_away",
+    "avg_goals_for_total", "failed_to_score_home", "failed_to_score_away",
+]
+
+_executor = ThreadPoolExecutor(max_workers=settings.PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+
+def _submit(fn, *args):
+    # Run in a copy of the caller's context so query timings land on the caller's job
+    return _executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+@dataclass
+class PrefetchedData:
+    user_id: str
+    matchday: str
+    formation: QueryResult
+    squad: QueryResult
+    fixtures: QueryResult
+    player_attacking: QueryResult
+    team_defensive: QueryResult
+    team_attacking: QueryResult
+    player_defensive: QueryResult
+    goalkeepers: QueryResult
+    injuries: QueryResult
+    player_features: QueryResult
+    standings: QueryResult
+    elapsed: float = field(default=0.0, compare=False)
+
+    @property
+    def formation_name(self) -> str | None:
+        return self.formation.rows[0][0] if self.formation.rows else None
+
+    def datasets(self) -> list[tuple[str, QueryResult]]:
+        return [(f.name, getattr(self, f.name)) for f in fields(self) if f.type is QueryResult]
+
+
+def fetch_league_data(matchday: str) -> dict[str, QueryResult]:
+    params = {"matchday": matchday}
+    futures = {
+        name: _submit(league_cache.get_or_load, settings.SEASON, matchday, name, lambda name=name: execute(name, params))
+        for name in LEAGUE_QUERIES
+    }
+    return {name: future.result() for name, future in futures.items()}
+
+
+def _load_player_statistics(since) -> QueryResult:
+    if since is None:
+        return execute("player_statistics")
+    return execute("player_statistics_changed", {"since": since})
+
+
+def fetch_player_features(matchday: str, league: dict[str, QueryResult]) -> MatchdayFeatures:
+    return feature_store.get(settings.SEASON, matchday, _load_player_statistics, league)
+
+
+def player_tables(squad: QueryResult, features: MatchdayFeatures) -> dict[str, QueryResult]:
+    # Index lookup of the squad in the feature table. Rows keep the squad's own api_player_id value
+    # so they join back to it whatever type the teamsheets column has.
+    squad_rows = squad.as_dicts()
+    positions, found = features.locate([int(row["api_player_id"]) for row in squad_rows])
+    views = {
+        "player_attacking": (PLAYER_ATTACKING_COLUMNS, None),
+        "player_defensive": (PLAYER_DEFENSIVE_COLUMNS, "Defender"),
+        "goalkeepers": (GOALKEEPER_COLUMNS, "Goalkeeper"),
+        "injuries": (INJURY_COLUMNS, None),
+        "player_features": (PLAYER_FEATURE_COLUMNS, None),
+    }
+    tables = {}
+    for label, (columns, position) in views.items():
+        rows = [
+            (row["api_player_id"],) + features.row(index, columns[1:])
+            for row, index, present in zip(squad_rows, positions, found)
+            if present and (position is None or row["position"] == position)
+        ]
+        tables[label] = QueryResult(columns=list(columns), rows=rows)
+    return tables
+
+
+def _assemble(user_id: str, matchday: str, results: dict, league: dict, features: MatchdayFeatures, elapsed: float) -> PrefetchedData:
+    # The squad's clubs and their opponents this round: the optimizer rates each fixture from both
+    # sides' statistics, and the analyst sees the same rows
+    team_ids = {row["team_id"] for row in results["squad"].as_dicts()}
+    for fixture in league["fixtures"].as_dicts():
+        if fixture["hteamid"] in team_ids or fixture["ateamid"] in team_ids:
+            team_ids.update((fixture["hteamid"], fixture["ateamid"]))
+    team_statistics = league["team_statistics"]
+    return PrefetchedData(
+        user_id=user_id,
+        matchday=matchday,
+        elapsed=elapsed,
+        team_defensive=team_statistics.select(TEAM_DEFENSIVE_COLUMNS, key="team_id", values=team_ids),
+        team_attacking=team_statistics.select(TEAM_ATTACKING_COLUMNS, key="team_id", values=team_ids),
+        fixtures=league["fixtures"],
+        standings=league["standings"],
+        **player_tables(results["squad"], features),
+        **results,
+    )
+
+
+def prefetch_user_data(user_id: str, matchday: str) -> PrefetchedData:
+    started = time.perf_counter()
+    params = {"user_id": user_id, "matchday": matchday, "season": settings.SEASON}
+    futures = {name: _submit(execute, name, params) for name in PREFETCH_QUERIES}
+    league = fetch_league_data(matchday)
+    # Joined in memory to the league tables, so read after them
+    features = fetch_player_features(matchday, league)
+    results = {label: future.result() for label, future in futures.items()}
+    elapsed = time.perf_counter() - started
+    logging.info(f"Prefetched {len(results) + len(league) + 1} data sets for user_id: {user_id} in {elapsed:.3f}s")
+    return _assemble(user_id, matchday, results, league, features, elapsed)
+
+
+def _split_by_user(result: QueryResult) -> dict[str, QueryResult]:
+    # The first column is the owning user_id; drop it so each user's result matches the single-user shape
+    split = {}
+    for row in result.rows:
+        split.setdefault(str(row[0]), []).append(tuple(row[1:]))
+    return {user_id: QueryResult(columns=result.columns[1:], rows=rows) for user_id, rows in split.items()}
+
+
+def prefetch_batch_data(user_ids: list[str], matchday: str) -> dict[str, PrefetchedData]:
+    started = time.perf_counter()
+    params = {"user_ids": list(user_ids), "matchday": matchday, "season": settings.SEASON}
+    futures = {label: _submit(execute, name, params) for label, name in BATCH_QUERIES.items()}
+    league = fetch_league_data(matchday)
+    features = fetch_player_features(matchday, league)
+    batch = {label: future.result() for label, future in futures.items()}
+    split = {label: _split_by_user(result) for label, result in batch.items()}
+    elapsed = time.perf_counter() - started
+
+    prefetched = {}
+    for user_id in user_ids:
+        results = {
+            label: split[label].get(str(user_id), QueryResult(columns=result.columns[1:], rows=[]))
+            for label, result in batch.items()
+        }
+        prefetched[user_id] = _assemble(user_id, matchday, results, league, features, elapsed)
+    logging.info(f"Prefetched data sets for {len(user_ids)} users in {elapsed:.3f}s")
+    return prefetched
+
+
+def load_data_dictionary() -> str:
+    with open(settings.DATA_DICTIONARY_PATH, encoding="utf-8") as f:
+        return f.read()
+
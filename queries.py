@@ -0,0 +1,140 @@
+from dataclasses import dataclass, field
+
+from sqlalchemy import bindparam, text
+
+import settings
+from database import get_engine
+from metrics import query_span
+
+# Registry of the SQL the service runs, by name. Every query takes bound parameters (never string
+# interpolation), its SQLAlchemy statement is built once, and the name doubles as the label in the
+# SQL latency metrics. On pg8000 (the Cloud SQL driver), whose DB-API cursor parses each statement
+# again on every execute, queries without list parameters are prepared once per pooled connection
+# and then only bound and executed.
+
+
+@dataclass
+class QueryResult:
+    columns: list[str]
+    rows: list[tuple]
+
+    def as_dicts(self) -> list[dict]:
+        return [dict(zip(self.columns, row)) for row in self.rows]
+
+    def select(self, columns: list[str], key: str | None = None, values=None) -> "QueryResult":
+        indexes = [self.columns.index(column) for column in columns]
+        rows = self.rows
+        if key is not None:
+            key_index = self.columns.index(key)
+            rows = [row for row in rows if row[key_index] in values]
+        return QueryResult(columns=list(columns), rows=[tuple(row[i] for i in indexes) for row in rows])
+
+
+@dataclass
+class NamedQuery:
+    name: str
+    sql: str
+    # List parameters, rendered as IN (...) with one bound value each. Unlike ANY(:array) this lets
+    # Postgres coerce each string id to the integer id columns, and also works on SQLite.
+    expanding: tuple = ()
+    statement: object = field(init=False, repr=False)
+
+    def __post_init__(self):
+        statement = text(self.sql)
+        if self.expanding:
+            statement = statement.bindparams(*(bindparam(name, expanding=True) for name in self.expanding))
+        self.statement = statement
+
+
+QUERIES: dict[str, NamedQuery] = {}
+
+
+def register(name: str, sql: str, expanding: tuple = ()) -> NamedQuery:
+    if name in QUERIES:
+        raise ValueError(f"Query {name} is already registered")
+    query = QUERIES[name] = NamedQuery(name=name, sql=sql, expanding=tuple(expanding))
+    return query
+
+
+# 1. Per-user data. Squads are read for the configured season only (settings.SEASON).
+register("formation", "select formation from users where id = :user_id")
+register("squad", (
+    "select t.api_player_id, t.name, p.position, te.name as team, p.teams_id as team_id "
+    "from teamsheets t left join players p on t.api_player_id = p.api_player_id "
+    "left join teams te on p.teams_id = te.id "
+    "where t.user_id = :user_id and t.season = :season and p.account_id = t.account_id ORDER BY p.position, t.api_player_id"
+))
+
+# 2. The same per-user data for many users at once, with the owning user_id as the first column
+register("batch_formation", "select id as user_id, formation from users where id IN :user_ids", expanding=("user_ids",))
+register("batch_squad", (
+    "select t.user_id, t.api_player_id, t.name, p.position, te.name as team, p.teams_id as team_id "
+    "from teamsheets t left join players p on t.api_player_id = p.api_player_id "
+    "left join teams te on p.teams_id = te.id "
+    "where t.user_id IN :user_ids and t.season = :season and p.account_id = t.account_id ORDER BY p.position, t.api_player_id"
+), expanding=("user_ids",))
+register("account_users", "select distinct user_id from teamsheets where account_id = :account_id and season = :season")
+register("season_users", "select distinct user_id from teamsheets where season = :season")
+
+# 3. League-wide tables, identical for every user on a matchday
+register("fixtures", "select round, hteamid, hteamname, ateamid, ateamname from prem_fixtures where round = :matchday")
+register("team_statistics", (
+    "select team_id, name, played_home, played_away, played_total, goals_against_home, goals_against_away, "
+    "avg_goals_against_home, avg_goals_against_away, avg_goals_against_total, clean_sheets_home, clean_sheets_away, "
+    "wins_home, wins_away, draws_home, draws_away, losses_home, losses_away, goals_for_home, goals_for_away, "
+    "avg_goals_for_home, avg_goals_for_away, avg_goals_for_total, failed_to_score_home, failed_to_score_away "
+    "from team_statistics"
+))
+register("standings", "select * from standings")
+
+# 4. Every player's season stats, read by feature_store.py and joined there to the cached league
+# tables. After the first load only players with a row updated since the previous refresh are read
+# again (all of their rows). A player with several rows keeps the one with the most appearances.
+PLAYER_STATISTICS_SQL = (
+    "select api_player_id, name, injured, team_id, team_name, appearances, lineups, position, rating, shots_total, shots_on, "
+    "goals_total, goals_assists, passes_key, passes_accuracy, dribbles_attempts, dribbles_success, fouls_drawn, "
+    "goals_conceded, goals_saves, tackles_total, tackles_blocks, tackles_interceptions, duels_total, duels_won, "
+    "fouls_committed, updated_at from player_statistics"
+)
+PLAYER_STATISTICS_ORDER = " order by api_player_id, appearances desc, team_id"
+register("player_statistics", PLAYER_STATISTICS_SQL + PLAYER_STATISTICS_ORDER)
+register("player_statistics_changed", (
+    PLAYER_STATISTICS_SQL + " where api_player_id in (select api_player_id from player_statistics where updated_at >= :since)"
+    + PLAYER_STATISTICS_ORDER
+))
+
+# 5. Connection check run at startup
+register("warm_up", "select 1")
+
+
+def _prepared(conn, query: NamedQuery):
+    # The statement prepared for this query on this pooled connection, or None when the driver is
+    # not pg8000. Kept in the connection's info dict, which lives as long as the DBAPI connection
+    # (across checkouts) and is cleared when the pool replaces it.
+    driver_connection = conn.connection.driver_connection
+    if not hasattr(driver_connection, "prepare_statement"):
+        return None
+    prepared_statements = conn.connection.info.setdefault("prepared_statements", {})
+    prepared = prepared_statements.get(query.name)
+    if prepared is None:
+        from pg8000.legacy import PreparedStatement
+
+        prepared = prepared_statements[query.name] = PreparedStatement(driver_connection, query.sql)
+    return prepared
+
+
+def execute(name: str, params: dict | None = None) -> QueryResult:
+    query = QUERIES[name]
+    params = params or {}
+    with query_span(name), get_engine().connect() as conn:
+        prepared = _prepared(conn, query) if settings.DB_PREPARED_STATEMENTS and not query.expanding else None
+        if prepared is not None:
+            try:
+                rows = prepared.run(**params)
+            except Exception:
+                # e.g. the table changed shape under the cached plan; prepare again next time
+                conn.connection.info["prepared_statements"].pop(query.name, None)
+                raise
+            return QueryResult(columns=[column["name"] for column in prepared.row_desc or []], rows=[tuple(row) for row in rows])
+        result = conn.execute(query.statement, params)
+        return QueryResult(columns=list(result.keys()), rows=[tuple(row) for row in result.fetchall()])
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import settings
+from prefetch import PrefetchedData
+
+# Content-addressed cache of finished recommendations. The key is a hash of everything the
+# analysis depends on (the prefetched inputs plus the prompt version), so a repeat request with
+# unchanged squad, fixtures, injuries and stats is answered without running the optimizer or the
+# crew again, while any change to the inputs naturally misses. Entries live in an in-memory LRU
+# and, optionally, a directory of JSON files capped by total size.
+
+
+def fingerprint(data: PrefetchedData, prompt_version: str) -> str:
+    snapshot = {"prompt_version": prompt_version, "matchday": data.matchday}
+    for label, result in data.datasets():
+        # Row order is not guaranteed by every query, so sort to keep the hash stable
+        snapshot[label] = {"columns": result.columns, "rows": sorted(json.dumps(row, default=str) for row in result.rows)}
+    encoded = json.dumps(snapshot, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class RecommendationCache:
+    def __init__(self, max_entries: int = 1024, cache_dir: str | None = None, max_bytes: int = 100 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                value = json.load(f)
+            # Touch so disk eviction is least-recently-used rather than oldest-written
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable recommendation cache entry {key}: {str(e)}")
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key: str, value: dict):
+        self._remember(key, value)
+        if not self.cache_dir:
+            return
+        try:
+            tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, default=str)
+            os.replace(tmp_path, self._path(key))
+            self._evict_disk()
+        except OSError as e:
+            logging.warning(f"Failed to write recommendation cache entry {key}: {str(e)}")
+
+    def _remember(self, key: str, value: dict):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+
+recommendation_cache = RecommendationCache(
+    max_entries=settings.RECOMMENDATION_CACHE_MAX_ENTRIES,
+    cache_dir=settings.RECOMMENDATION_CACHE_DIR,
+    max_bytes=settings.RECOMMENDATION_CACHE_MAX_BYTES,
+)
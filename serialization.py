@@ -0,0 +1,119 @@
+import csv
+import io
+import logging
+import re
+from decimal import Decimal
+
+import settings
+
+# Compact, columnar encoding of query results for LLM prompts. Each table is sent once as a
+# header row plus '|' delimited values; columns that are empty in every row are dropped, columns
+# holding the same value in every row are hoisted into a single 'same for all rows' line, and
+# floats are capped to a few decimal places. The per-player and per-team stat views can be merged
+# into one row per player / team so shared columns (name, team, appearances...) are sent once.
+
+DELIMITER = "|"
+PLAYER_TABLES = ("player_attacking", "player_defensive", "goalkeepers", "injuries", "player_features")
+TEAM_TABLES = ("team_defensive", "team_attacking")
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    # Words and punctuation marks are a close, dependency-free proxy for Gemini's tokenizer on
+    # this kind of tabular text; good enough for before/after comparisons.
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+def format_value(value, float_digits: int = settings.PROMPT_FLOAT_DIGITS) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (float, Decimal)):
+        text = f"{float(value):.{float_digits}f}".rstrip("0").rstrip(".")
+        return "0" if text in ("", "-0") else text
+    return str(value).replace(DELIMITER, "/").replace("\n", " ")
+
+
+def encode_table(label: str, columns: list[str], rows: list[tuple], float_digits: int = settings.PROMPT_FLOAT_DIGITS, sent_columns: set | None = None) -> str:
+    if not rows:
+        return f"## {label}\n(no rows)"
+    cells = [[format_value(value, float_digits) for value in row] for row in rows]
+    keep, constants = [], []
+    for i, column in enumerate(columns):
+        values = {row[i] for row in cells}
+        if values == {""}:
+            continue
+        if len(cells) > 1 and len(values) == 1:
+            constants.append(f"{column}={cells[0][i]}")
+            continue
+        keep.append(i)
+
+    if sent_columns is not None:
+        sent_columns.update(columns[i] for i in keep)
+        sent_columns.update(constant.split("=", 1)[0] for constant in constants)
+    lines = [f"## {label}"]
+    if constants:
+        lines.append(f"same for all rows: {', '.join(constants)}")
+    if keep:
+        lines.append(DELIMITER.join(columns[i] for i in keep))
+        lines.extend(DELIMITER.join(row[i] for i in keep) for row in cells)
+    return "\n".join(lines)
+
+
+def merge_tables(results: list, key: str) -> tuple[list[str], list[tuple]]:
+    # Outer-join results on key, keeping the first-seen column order and one row per key
+    columns, merged = [key], {}
+    for result in results:
+        for column in result.columns:
+            if column not in columns:
+                columns.append(column)
+        for row in result.as_dicts():
+            merged.setdefault(row[key], {}).update({k: v for k, v in row.items() if v is not None})
+    return columns, [tuple(values.get(column) for column in columns) for values in merged.values()]
+
+
+def encode_datasets(datasets: list[tuple[str, object]], merge: bool = settings.PROMPT_MERGE_TABLES) -> tuple[str, set[str]]:
+    # Returns the encoded text and the set of columns that made it into the prompt
+    tables = dict(datasets)
+    sections, sent_columns = [], set()
+    merged_done = set()
+    for label, result in datasets:
+        if merge and label in PLAYER_TABLES:
+            if "players" not in merged_done:
+                columns, rows = merge_tables([tables[name] for name in PLAYER_TABLES if name in tables], "api_player_id")
+                sections.append(encode_table("player_statistics", columns, rows, sent_columns=sent_columns))
+                merged_done.add("players")
+            continue
+        if merge and label in TEAM_TABLES:
+            if "teams" not in merged_done:
+                columns, rows = merge_tables([tables[name] for name in TEAM_TABLES if name in tables], "team_id")
+                sections.append(encode_table("team_statistics", columns, rows, sent_columns=sent_columns))
+                merged_done.add("teams")
+            continue
+        sections.append(encode_table(label, result.columns, result.rows, sent_columns=sent_columns))
+    return "\n\n".join(sections), sent_columns
+
+
+def encode_raw(datasets: list[tuple[str, object]]) -> str:
+    # The previous prompt format (Python repr of the row tuples), kept to measure savings against
+    return "\n".join(f"{label}: {result.rows}" for label, result in datasets)
+
+
+def compact_data_dictionary(dictionary_csv: str, columns: set[str]) -> str:
+    # Only the definitions for columns actually sent, once per (table, column)
+    lines, seen = [], set()
+    for row in csv.DictReader(io.StringIO(dictionary_csv)):
+        column, table = row["Column Name"], row["Source Database Table"]
+        if column not in columns or (table, column) in seen:
+            continue
+        seen.add((table, column))
+        lines.append(f"{table}.{column}: {row['AI Agent Definition & Usage']}")
+    return "\n".join(lines)
+
+
+def log_prompt_savings(label: str, before: str, after: str):
+    before_tokens, after_tokens = estimate_tokens(before), estimate_tokens(after)
+    saving = 100 * (1 - after_tokens / before_tokens) if before_tokens else 0.0
+    logging.info(f"Prompt size for {label}: ~{before_tokens} tokens raw, ~{after_tokens} tokens compact ({saving:.0f}% smaller)")
+    return before_tokens, after_tokens
@@ -0,0 +1,188 @@
+import logging
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from feature_store import fixture_lookup
+from optimizer import DEFENSIVE_SLOTS, POSITION_GROUPS, SUPPORTED_FORMATIONS, PlayerProjection, optimise_lineup, parse_formation, project_players
+from prefetch import PrefetchedData
+
+# Monte Carlo matchweek simulation for comparing lineups without the LLM. Each club's goals in its
+# fixture are drawn from a Poisson with the fixture rates the optimizer uses (fixture_goals_for /
+# fixture_goals_against from the feature table), and the goals it concedes are its opponent's draw. Each
+# picked player is drawn to play with their play_probability and, if they do, scores a Poisson
+# number of goals at their goals per appearance (goals_total / appearances), scaled by how many
+# goals their club scored in that simulated match against how many it was expected to. Each
+# simulated matchweek is scored with the game's rules:
+#   score = goals scored by the XI
+#           - floor(goals conceded by the fielded goalkeeper and defenders / 5)
+#           - 1 per defensive slot left unfilled or whose player does not play
+# so the mean score matches the optimizer's expected score. Every lineup in a request, home and
+# away, is scored against the same simulated matchweeks, so differences between lineups are not
+# noise from separate draws.
+
+MAX_LINEUP_SIZE = 11
+SCORE_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+@dataclass
+class LineupOutcome:
+    players: list[PlayerProjection]
+    # Picked players who cannot play: injured, or their club has no fixture this round
+    unavailable: list[dict]
+    unfilled_defensive_slots: int
+    goals_for: np.ndarray
+    goals_against: np.ndarray
+
+    @property
+    def scores(self) -> np.ndarray:
+        return self.goals_for - self.goals_against
+
+    def as_dict(self, opponent: "LineupOutcome | None" = None) -> dict:
+        scores = self.scores
+        outcome = {
+            "players": [player.as_dict() for player in self.players],
+            "unavailable": self.unavailable,
+            "unfilled_defensive_slots": self.unfilled_defensive_slots,
+            "expected_goals_for": round(float(self.goals_for.mean()), 3),
+            "expected_goals_against": round(float(self.goals_against.mean()), 3),
+            "expected_score": round(float(scores.mean()), 3),
+            "standard_error": round(float(scores.std() / np.sqrt(scores.size)), 4),
+            "score_percentiles": {f"p{q}": float(value) for q, value in zip(SCORE_PERCENTILES, np.percentile(scores, SCORE_PERCENTILES))},
+        }
+        if opponent is not None:
+            opponent_scores = opponent.scores
+            outcome["win_probability"] = round(float(np.mean(scores > opponent_scores)), 4)
+            outcome["draw_probability"] = round(float(np.mean(scores == opponent_scores)), 4)
+            outcome["loss_probability"] = round(float(np.mean(scores < opponent_scores)), 4)
+        return outcome
+
+
+def resolve_lineup(data: PrefetchedData, projections: dict[str, PlayerProjection], lineup: list) -> tuple[list[PlayerProjection], list[dict], int]:
+    # The lineup's available players, its picks that cannot play and its unfilled defensive slots.
+    # Raises ValueError for a lineup the game would not accept.
+    squad = {str(row["api_player_id"]): row for row in data.squad.as_dicts()}
+    ids = [str(api_player_id) for api_player_id in lineup]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"Lineup for user {data.user_id} picks a player more than once")
+    if len(ids) > MAX_LINEUP_SIZE:
+        raise ValueError(f"Lineup for user {data.user_id} picks {len(ids)} players; at most {MAX_LINEUP_SIZE} play")
+    missing = [api_player_id for api_player_id in ids if api_player_id not in squad]
+    if missing:
+        raise ValueError(f"Players {', '.join(missing)} are not in user {data.user_id}'s squad")
+    groups = [POSITION_GROUPS.get(squad[api_player_id]["position"]) for api_player_id in ids]
+    if None in groups:
+        raise ValueError(f"Lineup for user {data.user_id} picks a player with no playable position")
+    # Every position group within the user's formation, or within one of the supported formations
+    # when the user has none (as the optimizer chooses)
+    formations = [data.formation_name] if data.formation_name in SUPPORTED_FORMATIONS else list(SUPPORTED_FORMATIONS)
+    if not any(all(groups.count(group) <= slots for group, slots in parse_formation(formation).items()) for formation in formations):
+        counts = "-".join(str(groups.count(group)) for group in "DMF")
+        raise ValueError(
+            f"Lineup for user {data.user_id} ({groups.count('G')} goalkeeper, {counts}) does not fit formation {' or '.join(formations)}"
+        )
+
+    players = [projections[api_player_id] for api_player_id in ids if api_player_id in projections]
+    unavailable = [
+        {key: squad[api_player_id][key] for key in ("api_player_id", "name", "position")}
+        for api_player_id in ids if api_player_id not in projections
+    ]
+    fielded = sum(1 for player in players if player.group in DEFENSIVE_SLOTS)
+    return players, unavailable, sum(DEFENSIVE_SLOTS.values()) - fielded
+
+
+def _simulate_clubs(pool: list[PlayerProjection], fixtures, simulations: int, rng: np.random.Generator) -> tuple[dict, np.ndarray, np.ndarray]:
+    # Goals scored by the picked players' clubs and their opponents, one column per club. Each
+    # fixture takes two adjacent columns, so a club's opponent is in column index ^ 1.
+    lookup = fixture_lookup(fixtures)
+    clubs, rates = {}, []
+    for player in pool:
+        team_id = str(player.team_id)
+        if team_id in clubs:
+            continue
+        opponent_id = str(lookup[team_id][0])
+        # An opponent already paired elsewhere (a club with two fixtures) gets a column of its own
+        if opponent_id in clubs:
+            opponent_id = None
+        clubs[team_id] = len(rates)
+        if opponent_id is not None:
+            clubs[opponent_id] = len(rates) + 1
+        rates += [player.expected_team_scored, player.expected_team_conceded]
+    rates = np.array(rates, dtype=np.float64)
+    return clubs, rates, rng.poisson(rates, size=(simulations, rates.size)).astype(np.int32)
+
+
+def _simulate_players(pool: list[PlayerProjection], clubs: dict, rates: np.ndarray, goals: np.ndarray, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Per simulated matchweek and player: whether they play, goals scored and goals their club conceded
+    simulations = goals.shape[0]
+    columns = np.array([clubs[str(player.team_id)] for player in pool], dtype=np.intp)
+    plays = rng.random((simulations, len(pool))) < np.array([player.play_probability for player in pool])
+    # expected_goals is play_probability x goals per appearance x (fixture rate / season average),
+    # so a player who plays scores at expected_goals / play_probability on average. Scaling that by
+    # the club's simulated goals over its fixture rate keeps the mean and moves teammates together.
+    scoring_rates = np.array([
+        player.expected_goals / player.play_probability / rates[column] if player.play_probability and rates[column] > 0 else 0.0
+        for player, column in zip(pool, columns)
+    ])
+    scored = rng.poisson(scoring_rates[None, :] * goals[:, columns] * plays).astype(np.int32)
+    return plays, scored, goals[:, columns ^ 1]
+
+
+def simulate_matchweek(home: PrefetchedData, away: PrefetchedData, lineups: list[list] | None = None, away_lineup: list | None = None,
+                       simulations: int = 100000, seed: int | None = None, top_k: int = 5) -> dict:
+    # lineups are the home user's lineups to compare (lists of api_player_ids) and default to the
+    # optimizer's top_k; away_lineup defaults to the away user's optimizer pick.
+    started = time.perf_counter()
+    for data in (home, away):
+        if not data.squad.rows:
+            raise ValueError(f"User {data.user_id} has no squad")
+    home_projections = {str(player.api_player_id): player for player in project_players(home)}
+    away_projections = {str(player.api_player_id): player for player in project_players(away)}
+    if not lineups:
+        lineups = [[player.api_player_id for player in candidate.players] for candidate in optimise_lineup(home, top_k)]
+    if away_lineup is None:
+        # A squad with no available players has no optimizer pick and fields nobody
+        candidates = optimise_lineup(away, 1)
+        away_lineup = [player.api_player_id for player in candidates[0].players] if candidates else []
+    resolved = [resolve_lineup(home, home_projections, lineup) for lineup in lineups]
+    away_resolved = resolve_lineup(away, away_projections, away_lineup)
+
+    # One column per distinct player across every lineup
+    pool = {}
+    for players, _, _ in resolved + [away_resolved]:
+        for player in players:
+            pool.setdefault(str(player.api_player_id), (len(pool), player))
+    column = {api_player_id: index for api_player_id, (index, _) in pool.items()}
+
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1)[0])
+    rng = np.random.default_rng(seed)
+    players = [player for _, player in pool.values()]
+    clubs, rates, goals = _simulate_clubs(players, home.fixtures, simulations, rng)
+    plays, scored, conceded = _simulate_players(players, clubs, rates, goals, rng)
+
+    def outcome(players: list[PlayerProjection], unavailable: list[dict], unfilled: int) -> LineupOutcome:
+        members = [column[str(player.api_player_id)] for player in players]
+        defence = [column[str(player.api_player_id)] for player in players if player.group in DEFENSIVE_SLOTS]
+        fielded = plays[:, defence]
+        goals_against = (conceded[:, defence] * fielded).sum(axis=1) // 5 + (~fielded).sum(axis=1) + unfilled
+        return LineupOutcome(players, unavailable, unfilled, goals_for=scored[:, members].sum(axis=1), goals_against=goals_against)
+
+    away_outcome = outcome(*away_resolved)
+    outcomes = [outcome(*lineup) for lineup in resolved]
+    elapsed = time.perf_counter() - started
+    logging.info(
+        f"Simulated {simulations} matchweeks for {len(outcomes)} lineup(s) of user_id: {home.user_id} "
+        f"against user_id: {away.user_id} in {elapsed * 1000:.1f}ms"
+    )
+    return {
+        "user_id": home.user_id,
+        "away_user_id": away.user_id,
+        "matchday": home.matchday,
+        "simulations": simulations,
+        "seed": seed,
+        "lineups": [lineup.as_dict(opponent=away_outcome) for lineup in outcomes],
+        "away_lineup": away_outcome.as_dict(),
+        "elapsed_ms": round(elapsed * 1000, 1),
+    }
@@ -0,0 +1,59 @@
+import threading
+import time
+
+from job_queue import FINISHED_STATUSES
+
+# In-flight request coalescing. Requests with the same key share one job: the first starts it,
+# duplicates arriving while it is queued or running attach their callback URL to it, and within
+# the freshness window after it completes duplicates are answered from its payload without running
+# anything. Each distinct callback URL gets its own callback from the single execution.
+
+STARTED = "started"
+ATTACHED = "attached"
+RECENT = "recent"
+
+
+class SingleFlight:
+    def __init__(self, freshness: float = 0.0, on_attach=None):
+        self.freshness = freshness
+        # Called with the job after a callback URL is attached, e.g. to persist it
+        self.on_attach = on_attach
+        self._flights = {}
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: tuple, callback_url: str, start) -> tuple[object, str, dict | None]:
+        # Returns (job, outcome, payload); payload is only set for RECENT. start(callback_urls) is
+        # called under the lock, so two concurrent duplicates cannot both start a job, and must keep
+        # the given list on the job: attaching appends to it.
+        with self._lock:
+            flight = self._flights.get(key)
+            # A queued job that was cancelled never lands, so it no longer counts as in flight
+            if flight is not None and flight[0].status not in FINISHED_STATUSES:
+                job, callback_urls = flight
+                if callback_url not in callback_urls:
+                    callback_urls.append(callback_url)
+                    if self.on_attach:
+                        self.on_attach(job)
+                return job, ATTACHED, None
+            recent = self._recent.get(key)
+            if recent is not None and time.time() - recent[0] <= self.freshness:
+                return recent[1], RECENT, recent[2]
+            callback_urls = [callback_url]
+            job = start(callback_urls)
+            self._flights[key] = (job, callback_urls)
+            return job, STARTED, None
+
+    def land(self, key: tuple, job, payload: dict | None):
+        # Called once the job's result is ready and before its callbacks are sent: nothing attaches
+        # to the job afterwards. Later duplicates start a new job, or reuse this payload while fresh.
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight[0] is job:
+                del self._flights[key]
+            now = time.time()
+            if self.freshness > 0 and payload is not None and payload.get("status") == "completed":
+                self._recent[key] = (now, job, payload)
+            expired = [k for k, (finished_at, _, _) in self._recent.items() if now - finished_at > self.freshness]
+            for k in expired:
+                del self._recent[k]
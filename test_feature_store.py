@@ -0,0 +1,65 @@
+from datetime import datetime
+
+from feature_store import FeatureStore
+from queries import QueryResult
+
+MATCHDAY = "Regular Season - 1"
+PLAYER_COLUMNS = ["api_player_id", "name", "injured", "team_id", "appearances", "lineups", "goals_total", "updated_at"]
+TEAM_COLUMNS = ["team_id", "played_total", "avg_goals_for_home", "avg_goals_for_away", "avg_goals_for_total",
+                "avg_goals_against_home", "avg_goals_against_away"]
+LEAGUE = {
+    "fixtures": QueryResult(columns=["round", "hteamid", "hteamname", "ateamid", "ateamname"], rows=[(MATCHDAY, 1, "Club 1", 2, "Club 2")]),
+    "team_statistics": QueryResult(columns=TEAM_COLUMNS, rows=[(1, 10, 2.0, 1.2, 1.6, 0.9, 1.4), (2, 10, 1.1, 0.7, 0.9, 1.5, 2.1)]),
+}
+
+
+class PlayerStatistics:
+    # Stands in for the player_statistics queries: every row, or every row of the players with a row
+    # updated at or after since, recording each call
+    def __init__(self, rows: list[tuple]):
+        self.rows = rows
+        self.calls = []
+
+    def __call__(self, since) -> QueryResult:
+        self.calls.append(since)
+        changed = {row[0] for row in self.rows if since is None or row[-1] >= since}
+        rows = sorted((row for row in self.rows if row[0] in changed), key=lambda row: (row[0], -row[4]))
+        return QueryResult(columns=PLAYER_COLUMNS, rows=rows)
+
+
+def _player(api_player_id: int, team_id: int, appearances: int, goals: int, day: int) -> tuple:
+    return (api_player_id, f"Player {api_player_id}", "False", team_id, appearances, appearances, goals, datetime(2026, 1, day))
+
+
+def test_refresh_reads_only_changed_players():
+    loader = PlayerStatistics([_player(1, 1, 8, 4, 1), _player(2, 2, 6, 1, 1), _player(3, 1, 5, 0, 2)])
+    store = FeatureStore(ttl=0)
+    first = store.get("25-26", MATCHDAY, loader, LEAGUE)
+    assert loader.calls == [None]
+    assert first.row(0, ["venue", "opponent", "fixture_goals_for"]) == ("home", "Club 2", (2.0 + 2.1) / 2)
+
+    loader.rows[1] = _player(2, 2, 6, 3, 3)
+    second = store.get("25-26", MATCHDAY, loader, LEAGUE)
+    # Only rows at or after the newest updated_at already seen are read again
+    assert loader.calls == [None, datetime(2026, 1, 2)]
+    assert second.row(1, ["goals_per_appearance"]) == (0.5,)
+    assert second.row(0, ["expected_goals"]) == first.row(0, ["expected_goals"])
+    assert second.updated_through == datetime(2026, 1, 3)
+
+
+def test_duplicate_player_rows_keep_most_appearances():
+    loader = PlayerStatistics([_player(1, 2, 3, 3, 1), _player(1, 1, 8, 4, 1)])
+    features = FeatureStore(ttl=300).get("25-26", MATCHDAY, loader, LEAGUE)
+    assert len(features) == 1
+    assert features.row(0, ["team_id", "appearances"]) == (1, 8)
+
+
+def test_invalidate_reloads_every_player():
+    loader = PlayerStatistics([_player(1, 1, 8, 4, 1), _player(2, 2, 6, 1, 1)])
+    store = FeatureStore(ttl=300)
+    store.get("25-26", MATCHDAY, loader, LEAGUE)
+    del loader.rows[1]
+    assert store.invalidate(matchday=MATCHDAY) == 1
+    features = store.get("25-26", MATCHDAY, loader, LEAGUE)
+    assert loader.calls == [None, None]
+    assert list(features.ids) == [1]
@@ -0,0 +1,98 @@
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+import fast_api
+from job_queue import CANCELLED, COMPLETED, FINISHED_STATUSES, QUEUED, JobQueue
+
+
+class Recorder:
+    # Job handler that records the order jobs run in; a job with "block" waits until released
+    def __init__(self):
+        self.ran = []
+        self.release = threading.Event()
+
+    def __call__(self, job) -> dict:
+        self.ran.append(job.params["n"])
+        if job.params.get("block"):
+            self.release.wait(5)
+            job.check_cancelled()
+        return {"status": "completed", "n": job.params["n"]}
+
+
+def wait_finished(jobs, timeout: float = 5.0):
+    deadline = time.time() + timeout
+    while any(job.status not in FINISHED_STATUSES for job in jobs) and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_higher_priority_runs_first():
+    handler = Recorder()
+    jobs = JobQueue(handler, workers=1, max_depth=10)
+    submitted = [jobs.submit("single", {"n": n}, priority=priority) for n, priority in enumerate([0, 5, -1, 5, 1])]
+    jobs.start()
+    wait_finished(submitted)
+    jobs.stop()
+    # Equal priorities keep their submission order
+    assert handler.ran == [1, 3, 4, 0, 2]
+    assert [job.status for job in submitted] == [COMPLETED] * 5
+    assert submitted[1].result == {"status": "completed", "n": 1}
+
+
+def test_full_queue_answers_429(monkeypatch):
+    monkeypatch.setattr(fast_api, "job_queue", JobQueue(Recorder(), workers=1, max_depth=2))
+    # No lifespan, so the queue is never started and every job stays queued
+    client = TestClient(fast_api.app)
+    body = {"matchday": "Regular Season - 1", "callback_url": "http://rails.example/callbacks", "team_name": "Club"}
+    responses = [client.post("/api/v1/lineup-analysis", json={**body, "user_id": str(user_id)}) for user_id in range(3)]
+    assert [response.status_code for response in responses] == [202, 202, 429]
+    assert responses[2].headers["Retry-After"] == str(fast_api.settings.JOB_RETRY_AFTER)
+    assert fast_api.job_queue.depth() == 2
+
+
+def test_priority_is_bounded(monkeypatch):
+    monkeypatch.setattr(fast_api, "job_queue", JobQueue(Recorder(), workers=1, max_depth=10))
+    client = TestClient(fast_api.app)
+    body = {"matchday": "Regular Season - 1", "callback_url": "http://rails.example/callbacks", "team_name": "Club"}
+    statuses = [client.post("/api/v1/lineup-analysis", json={**body, "user_id": f"p{priority}", "priority": priority}).status_code for priority in (10, 11, -11)]
+    assert statuses == [202, 422, 422]
+    response = client.post("/api/v1/lineup-analysis/batch", json={"matchday": "Regular Season - 1", "users": [{"user_id": "1"}], "callback_url": body["callback_url"], "priority": 100})
+    assert response.status_code == 422
+
+
+def test_cancel_queued_and_running_jobs():
+    handler = Recorder()
+    jobs = JobQueue(handler, workers=1, max_depth=10)
+    jobs.start()
+    running = jobs.submit("single", {"n": 0, "block": True})
+    queued = jobs.submit("single", {"n": 1})
+    while running.status == QUEUED:
+        time.sleep(0.01)
+
+    # A queued job is dropped straight away and never runs
+    assert jobs.cancel(queued.job_id).status == CANCELLED
+    assert jobs.depth() == 0
+    # A running one stops at its next check
+    jobs.cancel(running.job_id)
+    handler.release.set()
+    wait_finished([running])
+    jobs.stop()
+    assert running.status == CANCELLED
+    assert handler.ran == [0]
+
+
+def test_unfinished_jobs_are_restored_after_restart(tmp_path):
+    store_path = str(tmp_path / "jobs.db")
+    before = JobQueue(Recorder(), workers=1, max_depth=10, store_path=store_path)
+    queued = before.submit("single", {"n": 7}, priority=3)
+
+    handler = Recorder()
+    after = JobQueue(handler, workers=1, max_depth=10, store_path=store_path)
+    after.start()
+    restored = after.get(queued.job_id)
+    wait_finished([restored])
+    after.stop()
+    assert (restored.priority, restored.status, handler.ran) == (3, COMPLETED, [7])
+    # Finished jobs stay readable from the store after another restart
+    assert JobQueue(Recorder(), workers=1, max_depth=10, store_path=store_path).get(queued.job_id).result == {"status": "completed", "n": 7}
@@ -0,0 +1,51 @@
+import pytest
+
+from league_cache import MatchdayCache
+
+
+class Loader:
+    # Counts loads and returns a new value each time
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self) -> int:
+        self.calls += 1
+        return self.calls
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("league_cache.time.time", lambda: now[0])
+    return now
+
+
+def test_tables_reload_after_ttl(clock):
+    cache, loader = MatchdayCache(ttl=60), Loader()
+    assert cache.get_or_load("25-26", "Regular Season - 1", "fixtures", loader) == 1
+    clock[0] += 59
+    assert cache.get_or_load("25-26", "Regular Season - 1", "fixtures", loader) == 1
+    clock[0] += 1
+    assert cache.get_or_load("25-26", "Regular Season - 1", "fixtures", loader) == 2
+
+
+def test_invalidate_by_matchday_and_season(clock, tmp_path):
+    cache, loader = MatchdayCache(ttl=60, cache_dir=str(tmp_path)), Loader()
+    for season, matchday in [("24-25", "Regular Season - 1"), ("25-26", "Regular Season - 1"), ("25-26", "Regular Season - 2")]:
+        cache.get_or_load(season, matchday, "standings", loader)
+
+    assert cache.invalidate(matchday="Regular Season - 1", season="25-26") == 1
+    assert cache.get_or_load("25-26", "Regular Season - 1", "standings", loader) == 4
+    assert cache.get_or_load("24-25", "Regular Season - 1", "standings", loader) == 1
+    # Both tiers are cleared: a new process sharing the directory loads again too
+    assert cache.invalidate(matchday="Regular Season - 2") == 1
+    assert MatchdayCache(ttl=60, cache_dir=str(tmp_path)).get_or_load("25-26", "Regular Season - 2", "standings", loader) == 5
+
+
+def test_disk_tier_survives_a_restart_until_the_ttl(clock, tmp_path):
+    loader = Loader()
+    MatchdayCache(ttl=60, cache_dir=str(tmp_path)).get_or_load("25-26", "Regular Season - 1", "team_statistics", loader)
+    restarted = MatchdayCache(ttl=60, cache_dir=str(tmp_path))
+    assert restarted.get_or_load("25-26", "Regular Season - 1", "team_statistics", loader) == 1
+    clock[0] += 60
+    assert MatchdayCache(ttl=60, cache_dir=str(tmp_path)).get_or_load("25-26", "Regular Season - 1", "team_statistics", loader) == 2
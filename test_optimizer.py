@@ -0,0 +1,106 @@
+from datetime import datetime
+
+import pytest
+
+from feature_store import FeatureStore
+from optimizer import optimise_lineup, project_players
+from prefetch import TEAM_ATTACKING_COLUMNS, TEAM_DEFENSIVE_COLUMNS, PrefetchedData, _assemble
+from queries import PLAYER_STATISTICS_SQL, QueryResult
+from simulation import resolve_lineup, simulate_matchweek
+
+# A small league: four clubs, two fixtures, and two squads drawn from it, assembled the way the
+# service does (player feature table plus per-user slices). The optimizer's analytic expected score
+# is checked against the Monte Carlo simulation, which scores the same lineup under the game's rules
+# by drawing every match.
+
+MATCHDAY = "Regular Season - 1"
+TEAM_STATISTICS = {
+    1: {"team_id": 1, "name": "Club 1", "played_total": 10, "avg_goals_for_home": 2.1, "avg_goals_for_away": 1.4,
+        "avg_goals_for_total": 1.75, "avg_goals_against_home": 0.8, "avg_goals_against_away": 1.3},
+    2: {"team_id": 2, "name": "Club 2", "played_total": 10, "avg_goals_for_home": 1.2, "avg_goals_for_away": 0.9,
+        "avg_goals_for_total": 1.05, "avg_goals_against_home": 1.6, "avg_goals_against_away": 2.2},
+    3: {"team_id": 3, "name": "Club 3", "played_total": 10, "avg_goals_for_home": 1.7, "avg_goals_for_away": 1.1,
+        "avg_goals_for_total": 1.4, "avg_goals_against_home": 1.0, "avg_goals_against_away": 1.5},
+    4: {"team_id": 4, "name": "Club 4", "played_total": 10, "avg_goals_for_home": 1.5, "avg_goals_for_away": 1.3,
+        "avg_goals_for_total": 1.4, "avg_goals_against_home": 1.9, "avg_goals_against_away": 1.2},
+}
+TEAM_COLUMNS = list(dict.fromkeys(TEAM_DEFENSIVE_COLUMNS + TEAM_ATTACKING_COLUMNS))
+LEAGUE = {
+    "fixtures": QueryResult(
+        columns=["round", "hteamid", "hteamname", "ateamid", "ateamname"],
+        rows=[(MATCHDAY, 1, "Club 1", 2, "Club 2"), (MATCHDAY, 3, "Club 3", 4, "Club 4")],
+    ),
+    "team_statistics": QueryResult(columns=TEAM_COLUMNS, rows=[tuple(row.get(column) for column in TEAM_COLUMNS) for row in TEAM_STATISTICS.values()]),
+    "standings": QueryResult(columns=[], rows=[]),
+}
+# The columns the player_statistics queries return
+PLAYER_COLUMNS = PLAYER_STATISTICS_SQL.split("select ")[1].split(" from ")[0].split(", ")
+POSITIONS = ["Goalkeeper"] * 2 + ["Defender"] * 6 + ["Midfielder"] * 6 + ["Attacker"] * 4
+# user_id -> (first api_player_id, the two clubs the squad alternates between)
+SQUADS = {"1": (100, (1, 3)), "2": (200, (2, 4))}
+
+
+def _league_data() -> dict[str, PrefetchedData]:
+    # Varied appearances and goals; player 117 has no player_statistics row
+    squads, stats = {}, []
+    for user_id, (first_id, clubs) in SQUADS.items():
+        squads[user_id] = []
+        for i, position in enumerate(POSITIONS):
+            api_player_id, team_id = first_id + i, clubs[i % 2]
+            squads[user_id].append((api_player_id, f"Player {api_player_id}", position, f"Club {team_id}", team_id))
+            if api_player_id != 117:
+                appearances = 3 + (i * 7) % 8
+                goals = (i * 5) % 4 if position != "Goalkeeper" else 0
+                row = {
+                    "api_player_id": api_player_id, "name": f"Player {api_player_id}", "injured": "False", "team_id": team_id,
+                    "team_name": f"Club {team_id}", "appearances": appearances, "lineups": appearances, "position": position,
+                    "goals_total": goals, "updated_at": datetime(2026, 1, 1),
+                }
+                stats.append(tuple(row.get(column) for column in PLAYER_COLUMNS))
+    features = FeatureStore(ttl=300).get("25-26", MATCHDAY, lambda since: QueryResult(columns=PLAYER_COLUMNS, rows=stats), LEAGUE)
+    return {
+        user_id: _assemble(user_id, MATCHDAY, {
+            "formation": QueryResult(columns=["formation"], rows=[("4-4-2",)]),
+            "squad": QueryResult(columns=["api_player_id", "name", "position", "team", "team_id"], rows=squad),
+        }, LEAGUE, features, 0.0)
+        for user_id, squad in squads.items()
+    }
+
+
+def test_simulated_mean_matches_analytic_expected_score():
+    data = _league_data()
+    best = optimise_lineup(data["1"], top_k=1)[0]
+
+    result = simulate_matchweek(data["1"], data["2"], lineups=[[player.api_player_id for player in best.players]], simulations=400000, seed=11)
+    simulated = result["lineups"][0]
+    assert abs(simulated["expected_goals_for"] - best.expected_goals_for) < 0.01
+    assert abs(simulated["expected_score"] - best.expected_score) < 4 * simulated["standard_error"]
+
+
+def test_projections_match_features_sent_to_analyst():
+    data = _league_data()["1"]
+    # The squad's clubs and their opponents, so the analyst sees the statistics behind each fixture rate
+    assert {row[0] for row in data.team_defensive.rows} == {1, 2, 3, 4}
+    features = {row["api_player_id"]: row for row in data.player_features.as_dicts()}
+    projections = project_players(data)
+    assert len(projections) == len(POSITIONS)
+    for player in projections:
+        if player.api_player_id == 117:
+            # No statistics: default play probability, rated from the prefetched team tables
+            assert (player.play_probability, player.expected_goals) == (0.5, 0.0)
+            assert player.expected_team_conceded == (1.0 + 1.3) / 2
+            continue
+        feature = features[player.api_player_id]
+        assert (player.play_probability, player.expected_goals) == (feature["play_probability"], feature["expected_goals"])
+        assert (player.expected_team_scored, player.expected_team_conceded) == (feature["fixture_goals_for"], feature["fixture_goals_against"])
+
+
+def test_simulated_lineup_must_fit_formation():
+    data = _league_data()["1"]
+    projections = {str(player.api_player_id): player for player in project_players(data)}
+    # 1 goalkeeper, 4 defenders, 5 midfielders: too many midfielders for the user's 4-4-2
+    with pytest.raises(ValueError, match="does not fit formation 4-4-2"):
+        resolve_lineup(data, projections, [100] + list(range(102, 106)) + list(range(108, 113)))
+    # A partial 4-4-2 is accepted; its empty defensive slots are penalised instead
+    players, _, unfilled = resolve_lineup(data, projections, [108, 109, 114])
+    assert unfilled == 5 and len(players) == 3
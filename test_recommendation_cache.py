@@ -0,0 +1,43 @@
+import dataclasses
+import os
+
+from prefetch import PrefetchedData
+from queries import QueryResult
+from recommendation_cache import RecommendationCache, fingerprint
+
+
+def _prefetched(injuries: list[tuple]) -> PrefetchedData:
+    tables = {field.name: QueryResult(columns=[], rows=[]) for field in dataclasses.fields(PrefetchedData) if field.type is QueryResult}
+    tables["injuries"] = QueryResult(columns=["api_player_id", "reason"], rows=injuries)
+    return PrefetchedData(user_id="1", matchday="Regular Season - 1", **tables)
+
+
+def test_fingerprint_changes_with_inputs_and_prompt_version():
+    data = _prefetched([(101, "Knock"), (102, "Suspended")])
+    # Row order alone does not change the key
+    assert fingerprint(data, "3") == fingerprint(_prefetched([(102, "Suspended"), (101, "Knock")]), "3")
+    assert fingerprint(data, "3") != fingerprint(_prefetched([(101, "Knock")]), "3")
+    assert fingerprint(data, "3") != fingerprint(data, "4")
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = RecommendationCache(max_entries=2)
+    cache.put("a", {"result": "a"})
+    cache.put("b", {"result": "b"})
+    assert cache.get("a") == {"result": "a"}
+    cache.put("c", {"result": "c"})
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ({"result": "a"}, {"result": "c"})
+
+
+def test_disk_tier_survives_a_restart_and_is_capped_by_size(tmp_path):
+    cache = RecommendationCache(cache_dir=str(tmp_path), max_bytes=100)
+    cache.put("a", {"result": "x" * 30})
+    cache.put("b", {"result": "y" * 30})
+    assert RecommendationCache(cache_dir=str(tmp_path)).get("a") == {"result": "x" * 30}
+
+    # Make "b" the least recently used on disk (writes in the same instant can share an mtime), so it goes first once over the cap
+    os.utime(tmp_path / "b.json", (0, 0))
+    cache.put("c", {"result": "z" * 30})
+    assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json"]
+    assert RecommendationCache(cache_dir=str(tmp_path)).get("b") is None
@@ -0,0 +1,56 @@
+from decimal import Decimal
+
+from queries import QueryResult
+from serialization import DELIMITER, encode_datasets, encode_table, format_value, merge_tables
+
+PLAYER_ATTACKING = QueryResult(
+    columns=["api_player_id", "name", "team_id", "goals_total", "rating", "shots_total"],
+    rows=[(101, "Alpha", 1, 4, 7.1234, None), (102, "Bravo|Jr", 1, 0, Decimal("6.5"), None), (103, "Charlie", 1, 2, 6.0, None)],
+)
+PLAYER_DEFENSIVE = QueryResult(
+    columns=["api_player_id", "name", "tackles_total", "injured"],
+    rows=[(101, "Alpha", 12, False), (103, "Charlie", None, True), (104, "Delta", 3, False)],
+)
+
+
+def decode_table(text: str) -> tuple[str, list[dict]]:
+    # Reads encode_table's output back into one dict per row, with the hoisted constants filled in
+    lines = text.split("\n")
+    label, lines = lines[0].removeprefix("## "), lines[1:]
+    constants = {}
+    if lines and lines[0].startswith("same for all rows: "):
+        constants = dict(item.split("=", 1) for item in lines[0].removeprefix("same for all rows: ").split(", "))
+        lines = lines[1:]
+    if not lines:
+        return label, [constants]
+    header = lines[0].split(DELIMITER)
+    return label, [{**constants, **dict(zip(header, line.split(DELIMITER)))} for line in lines[1:]]
+
+
+def test_merged_tables_round_trip():
+    columns, rows = merge_tables([PLAYER_ATTACKING, PLAYER_DEFENSIVE], "api_player_id")
+    # One row per player in first-seen order; each column once, filled from whichever view has it
+    assert columns == ["api_player_id", "name", "team_id", "goals_total", "rating", "shots_total", "tackles_total", "injured"]
+    assert [row[0] for row in rows] == [101, 102, 103, 104]
+
+    label, decoded = decode_table(encode_table("player_statistics", columns, rows, float_digits=2))
+    assert label == "player_statistics"
+    # Columns empty in every row are dropped; the rest survive as their formatted values
+    expected = [
+        {column: format_value(value, 2) for column, value in zip(columns, row) if column != "shots_total"}
+        for row in rows
+    ]
+    assert decoded == expected
+    assert decoded[0]["rating"] == "7.12" and decoded[1]["name"] == "Bravo/Jr" and decoded[2]["injured"] == "true"
+
+
+def test_constant_columns_are_hoisted():
+    text = encode_table("player_attacking", PLAYER_ATTACKING.columns, PLAYER_ATTACKING.rows)
+    assert text.split("\n")[1] == "same for all rows: team_id=1"
+    assert decode_table(text)[1][2] == {"api_player_id": "103", "name": "Charlie", "team_id": "1", "goals_total": "2", "rating": "6"}
+
+
+def test_encoded_datasets_report_the_columns_sent():
+    text, sent = encode_datasets([("player_attacking", PLAYER_ATTACKING), ("player_defensive", PLAYER_DEFENSIVE)], merge=True)
+    assert text.startswith("## player_statistics\n")
+    assert sent == {"api_player_id", "name", "team_id", "goals_total", "rating", "tackles_total", "injured"}
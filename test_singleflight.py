@@ -0,0 +1,59 @@
+from job_queue import CANCELLED, Job
+from singleflight import ATTACHED, RECENT, STARTED, SingleFlight
+
+KEY = ("1", "Regular Season - 1", "Club")
+
+
+class Starter:
+    # Stands in for enqueue_job: keeps the callback list on the job, as fast_api does
+    def __init__(self):
+        self.jobs = []
+
+    def __call__(self, callback_urls: list[str]) -> Job:
+        job = Job(kind="single", params={"callback_urls": callback_urls})
+        self.jobs.append(job)
+        return job
+
+
+def test_duplicates_attach_to_the_running_job():
+    start, persisted = Starter(), []
+    flights = SingleFlight(on_attach=persisted.append)
+    job, outcome, _ = flights.join(KEY, "http://a.example/cb", start)
+    assert outcome == STARTED
+    assert flights.join(KEY, "http://b.example/cb", start)[:2] == (job, ATTACHED)
+    # The same URL again is not called back twice
+    assert flights.join(KEY, "http://a.example/cb", start)[:2] == (job, ATTACHED)
+    assert job.params["callback_urls"] == ["http://a.example/cb", "http://b.example/cb"]
+    assert persisted == [job]
+    assert len(start.jobs) == 1
+    # Other keys run separately
+    assert flights.join(("2",) + KEY[1:], "http://a.example/cb", start)[1] == STARTED
+
+
+def test_completed_result_is_reused_while_fresh(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("singleflight.time.time", lambda: now[0])
+    start = Starter()
+    flights = SingleFlight(freshness=30)
+    job, _, _ = flights.join(KEY, "http://a.example/cb", start)
+    payload = {"status": "completed", "user_id": "1"}
+    flights.land(KEY, job, payload)
+
+    now[0] += 30
+    assert flights.join(KEY, "http://b.example/cb", start) == (job, RECENT, payload)
+    now[0] += 1
+    assert flights.join(KEY, "http://b.example/cb", start)[1] == STARTED
+    assert len(start.jobs) == 2
+
+
+def test_failures_and_cancelled_jobs_are_not_reused():
+    start = Starter()
+    flights = SingleFlight(freshness=30)
+    job, _, _ = flights.join(KEY, "http://a.example/cb", start)
+    flights.land(KEY, job, {"status": "failed", "user_id": "1"})
+    assert flights.join(KEY, "http://a.example/cb", start)[1] == STARTED
+
+    # A queued job cancelled before it ran never lands, but no longer takes duplicates
+    start.jobs[-1].status = CANCELLED
+    assert flights.join(KEY, "http://a.example/cb", start)[1] == STARTED
+    assert len(start.jobs) == 3
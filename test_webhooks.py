@@ -0,0 +1,92 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from webhooks import CallbackDispatcher
+
+
+class RailsStub(ThreadingHTTPServer):
+    # Records every callback POST and answers each with the next of its status codes (the last repeats)
+    def __init__(self, statuses: list[int]):
+        super().__init__(("127.0.0.1", 0), CallbackHandler)
+        self.statuses = statuses
+        self.received = []
+        self.url = f"http://127.0.0.1:{self.server_port}"
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.received.append((self.path, body))
+        status = self.server.statuses[min(len(self.server.received), len(self.server.statuses)) - 1]
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def rails():
+    servers = []
+
+    def serve(statuses: list[int]) -> RailsStub:
+        server = RailsStub(statuses)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_retries_then_delivers(rails):
+    server = rails([503, 503, 200])
+    dispatcher = CallbackDispatcher(max_attempts=5, backoff_base=0.01)
+    dispatcher.dispatch(f"{server.url}/callbacks", {"status": "completed", "user_id": "1"}, label="user_id: 1")
+    dispatcher.stop()
+    assert [body for _, body in server.received] == [{"status": "completed", "user_id": "1"}] * 3
+    assert not dispatcher.dead_letters
+
+
+def test_dead_letters_once_attempts_run_out(rails, tmp_path):
+    server = rails([503])
+    dead_letter_path = tmp_path / "dead_letters.jsonl"
+    dispatcher = CallbackDispatcher(max_attempts=3, backoff_base=0.01, dead_letter_path=str(dead_letter_path))
+    dispatcher.dispatch(f"{server.url}/callbacks", {"status": "completed", "user_id": "1"}, label="user_id: 1")
+    dispatcher.stop()
+    assert len(server.received) == 3
+    record = json.loads(dead_letter_path.read_text())
+    assert (record["url"], record["payload"]["user_id"], record["error"]) == (f"{server.url}/callbacks", "1", "HTTP 503")
+    assert list(dispatcher.dead_letters) == [record]
+
+
+def test_client_errors_are_not_retried(rails):
+    server = rails([404])
+    dispatcher = CallbackDispatcher(max_attempts=5, backoff_base=0.01)
+    dispatcher.dispatch(f"{server.url}/callbacks", {"status": "completed"})
+    dispatcher.stop()
+    assert len(server.received) == 1
+    assert dispatcher.dead_letters[0]["error"] == "HTTP 404"
+
+
+def test_callbacks_to_one_url_are_coalesced(rails):
+    server = rails([200])
+    # A long window, so only the size limit and the flush on stop send anything
+    dispatcher = CallbackDispatcher(batch_window=60, batch_max_size=3)
+    for user_id in range(5):
+        dispatcher.dispatch(f"{server.url}/callbacks", {"user_id": str(user_id)})
+    dispatcher.dispatch(f"{server.url}/other", {"user_id": "other"})
+    dispatcher.stop()
+    batches = sorted(server.received, key=lambda received: (received[0], -len(received[1].get("callbacks", []))))
+    assert batches == [
+        ("/callbacks", {"status": "batch", "callbacks": [{"user_id": "0"}, {"user_id": "1"}, {"user_id": "2"}]}),
+        ("/callbacks", {"status": "batch", "callbacks": [{"user_id": "3"}, {"user_id": "4"}]}),
+        # A lone callback is sent as it is
+        ("/other", {"user_id": "other"}),
+    ]
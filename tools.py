@@ -0,0 +1,21 @@
+from sqlalchemy import text
+from crewai.tools import BaseTool
+
+from database import get_engine
+from metrics import query_span
+from serialization import encode_table
+
+
+class CloudSQLQueryTool(BaseTool):
+    name: str = "Cloud SQL Query Tool"
+    description: str = "Use this tool to query the Google Cloud SQL database. Input should be a raw SQL query."
+    # Label for the SQL latency metrics; the queries themselves are free-form
+    query_label: str = "cloud_sql_tool"
+
+    def _run(self, query: str) -> str:
+        # Borrow a connection from the shared pool rather than opening a new connector per query
+        with query_span(self.query_label), get_engine().connect() as conn:
+            result = conn.execute(text(query))
+            rows = result.fetchall()
+            # Header row plus '|' delimited values rather than a repr of unlabelled tuples
+            return encode_table("result", list(result.keys()), [tuple(row) for row in rows])
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+
+import settings
+from metrics import CALLBACK_POST_SECONDS, CALLBACKS
+
+# Callback delivery to the Rails app. Workers hand payloads to dispatch() and carry on; delivery
+# happens on a dedicated asyncio loop sharing one keep-alive httpx.AsyncClient pool. Failed sends
+# are retried with exponential backoff and, once attempts run out, recorded as dead letters.
+# With CALLBACK_BATCH_WINDOW_MS set, callbacks to the same URL within the window are coalesced
+# into a single POST of {"status": "batch", "callbacks": [...]}.
+
+# 4xx responses other than these are treated as permanent failures and not retried
+RETRYABLE_CLIENT_ERRORS = {408, 409, 425, 429}
+
+
+class CallbackDispatcher:
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        timeout: float = 30.0,
+        max_connections: int = 20,
+        batch_window: float = 0.0,
+        batch_max_size: int = 50,
+        dead_letter_path: str | None = None,
+    ):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.batch_window = batch_window
+        self.batch_max_size = batch_max_size
+        self.dead_letter_path = dead_letter_path
+        self.dead_letters = deque(maxlen=1000)
+        self._loop = None
+        self._thread = None
+        self._client = None
+        self._pending = set()
+        self._batches = {}
+        self._start_lock = threading.Lock()
+        self._file_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            ready = threading.Event()
+            self._loop = asyncio.new_event_loop()
+
+            def run():
+                asyncio.set_event_loop(self._loop)
+                self._client = httpx.AsyncClient(
+                    timeout=self.timeout,
+                    limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                )
+                ready.set()
+                self._loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name="callback-dispatcher", daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def stop(self, timeout: float = 10.0):
+        with self._start_lock:
+            if self._thread is None:
+                return
+            # Flush coalesced batches and wait for in-flight deliveries before closing the pool
+            future = asyncio.run_coroutine_threadsafe(self._drain(), self._loop)
+            try:
+                future.result(timeout=timeout)
+            except Exception as e:
+                logging.warning(f"Callback dispatcher stopped with deliveries outstanding: {str(e)}")
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=timeout)
+            self._thread = None
+            self._loop = None
+
+    def dispatch(self, url: str, payload: dict, label: str = ""):
+        # Safe to call from any thread; never blocks on the network
+        if self._thread is None:
+            self.start()
+        self._loop.call_soon_threadsafe(self._schedule, str(url), payload, label)
+
+    def _schedule(self, url: str, payload: dict, label: str):
+        if self.batch_window <= 0:
+            self._track(self._deliver(url, payload, label))
+            return
+        batch = self._batches.get(url)
+        if batch is None:
+            batch = self._batches[url] = {"payloads": [], "labels": []}
+            batch["timer"] = self._loop.call_later(self.batch_window, self._flush, url)
+        batch["payloads"].append(payload)
+        batch["labels"].append(label)
+        if len(batch["payloads"]) >= self.batch_max_size:
+            self._flush(url)
+
+    def _flush(self, url: str):
+        batch = self._batches.pop(url, None)
+        if batch is None:
+            return
+        batch["timer"].cancel()
+        if len(batch["payloads"]) == 1:
+            self._track(self._deliver(url, batch["payloads"][0], batch["labels"][0]))
+        else:
+            payload = {"status": "batch", "callbacks": batch["payloads"]}
+            self._track(self._deliver(url, payload, f"batch of {len(batch['payloads'])}"))
+
+    def _track(self, coroutine):
+        task = self._loop.create_task(coroutine)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _drain(self):
+        for url in list(self._batches):
+            self._flush(url)
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        await self._client.aclose()
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _deliver(self, url: str, payload: dict, label: str):
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with CALLBACK_POST_SECONDS.time():
+                    response = await self._client.post(url, json=payload)
+                if response.status_code < 400:
+                    CALLBACKS.labels(outcome="delivered").inc()
+                    logging.info(f"Callback successfully sent to Rails for {label} (attempt {attempt})")
+                    return
+                error = f"HTTP {response.status_code}"
+                if response.status_code < 500 and response.status_code not in RETRYABLE_CLIENT_ERRORS:
+                    break
+            except httpx.HTTPError as e:
+                error = f"{type(e).__name__}: {str(e)}"
+            except Exception as e:
+                # e.g. httpx.InvalidURL or a payload that is not JSON serialisable: retrying cannot help
+                error = f"{type(e).__name__}: {str(e)}"
+                break
+            if attempt < self.max_attempts:
+                delay = self._backoff(attempt)
+                CALLBACKS.labels(outcome="retried").inc()
+                logging.warning(f"Callback to Rails for {label} failed ({error}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        self._dead_letter(url, payload, label, error)
+
+    def _dead_letter(self, url: str, payload: dict, label: str, error: str | None):
+        CALLBACKS.labels(outcome="dead_letter").inc()
+        logging.error(f"Failed to transmit callback to Rails for {label}: {error}")
+        record = {"url": url, "payload": payload, "label": label, "error": error, "failed_at": time.time()}
+        self.dead_letters.append(record)
+        if self.dead_letter_path:
+            try:
+                with self._file_lock, open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+            except OSError as e:
+                logging.error(f"Failed to write dead letter for {label}: {str(e)}")
+
+
+callback_dispatcher = CallbackDispatcher(
+    max_attempts=settings.CALLBACK_MAX_ATTEMPTS,
+    backoff_base=settings.CALLBACK_BACKOFF_BASE,
+    backoff_max=settings.CALLBACK_BACKOFF_MAX,
+    timeout=settings.CALLBACK_TIMEOUT,
+    max_connections=settings.CALLBACK_MAX_CONNECTIONS,
+    batch_window=settings.CALLBACK_BATCH_WINDOW_MS / 1000,
+    batch_max_size=settings.CALLBACK_BATCH_MAX_SIZE,
+    dead_letter_path=settings.CALLBACK_DEAD_LETTER_PATH,
+)